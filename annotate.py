@@ -1,19 +1,55 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
 
 from checkbox_tool import CheckboxTool
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Annotate test plan includes with their plugin.")
+    parser.add_argument(
+        'test_plan', nargs='?',
+        help="test plan to print annotated (not needed with --all/--provider)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--all', action='store_true',
+                       help="annotate every test plan of every provider")
+    group.add_argument('--provider', metavar='NAME',
+                       help="annotate every test plan of this provider")
+    parser.add_argument(
+        '--output-dir', metavar='DIR',
+        help="write annotated .pxu files here instead of in place")
+    parser.add_argument('--report-ambiguous', action='store_true',
+                        help="list includes that match several equally "
+                             "specific templates on stderr")
+    parser.add_argument('--timing', action='store_true',
+                        help="print a startup time breakdown to stderr")
+    args = parser.parse_args()
+    if bool(args.test_plan) == bool(args.all or args.provider):
+        parser.error("give either a test plan, or --all or --provider")
+
     tool = CheckboxTool()
-    if len(sys.argv) != 2:
-        raise SystemExit("missing argument: test plan!")
-    tp = sys.argv[1]
-    if tp not in tool.all_tps:
-        raise SystemExit('"{}" test plan not found!'.format(tp))
-    
-    print(tool.annotated_tp(tp))
+    if args.test_plan:
+        tp = args.test_plan
+        if tp not in tool.all_tps:
+            raise SystemExit('"{}" test plan not found!'.format(tp))
+        print(tool.annotated_tp(tp))
+    else:
+        if args.all:
+            tps = tool.all_tps
+        else:
+            tps = tool.get_provider_test_plans(args.provider)
+            if not tps:
+                raise SystemExit('No test plans found for provider "{}"!'.format(
+                    args.provider))
+        try:
+            tool.annotate_tps(tps, args.output_dir)
+        except (ValueError, PermissionError) as exc:
+            raise SystemExit(exc)
+    if args.report_ambiguous:
+        tool.print_ambiguous()
+    if args.timing:
+        tool.print_timings()
 
 if __name__ == '__main__':
     main()
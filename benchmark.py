@@ -20,94 +20,1129 @@ Benchmark Checkbox with different scenarios.
 This program runs a particular launcher and measures how long it took to run
 it.  Place this file and the benchmarking-provider provider in the checkbox-ng
 tree and run it.
+
+Every scenario is run a few times to warm up and then a number of measured
+times, or, with --auto, until the measurements are stable enough.  With
+--phases, the runs are traced by benchmarking-trace/sitecustomize.py and the
+time is broken down into stages of the checkbox-cli run.  With --profile,
+every scenario is run once under cProfile instead (both master and slave for
+remote runs) and the hotspots are reported.
+
+With --sweep, the scenarios are synthetic loads generated by synthetic.py for
+a grid of sizes instead, and the summary ends with scaling curves that show
+where the duration grows faster than the load.
+
+With --jobs, several scenarios are run at the same time.  Every worker has its
+own copy of the provider, PROVIDERPATH, XDG directories and slave port, and
+with --pin its own CPUs.
+
+Next to the duration, every run records the resources used by checkbox-cli
+(the local process, or master and slave): peak RSS, user and system CPU time,
+context switches and bytes read from and written to block devices.  Remote
+runs are only timed from when the slave accepts connections, how long the
+slave took to get there is reported separately.  With --rpc-stats, the master
+talks to the slave through rpc_proxy.py, which counts the calls and the bytes
+exchanged.
 """
 
+import argparse
+import collections
 import contextlib
+import csv
+import datetime
+import functools
 import glob
+import json
+import math
 import os
+import platform
+import pstats
+import queue
+import shlex
+import shutil
 import signal
+import socket
+import statistics
 import subprocess
 import sys
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from pprint import pprint
+import rpc_proxy
+import synthetic
+import venv_cache
 
+# two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom; above 30 the normal distribution is close enough
+T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+Z_95 = 1.960
 
-def prepare_venv(venv_path):
-    """Create venv and develop the benchmarking provider in it."""
+TRACE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmarking-trace')
+# bump when records written by --output change incompatibly
+RESULTS_FORMAT = 1
+
+VERSIONS_SCRIPT = """
+import platform
+print(platform.python_version())
+try:
+    import pkg_resources
+    print(pkg_resources.get_distribution('checkbox-ng').version)
+except Exception:
+    print('unknown')
+"""
+
+ISOLATED_VARIABLES = ['PROVIDERPATH', 'XDG_CACHE_HOME', 'XDG_CONFIG_HOME',
+                      'XDG_DATA_HOME']
+PROVIDER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmarking-provider')
+
+
+def activate(venv_path):
+    """Shell command prefix that runs the rest in the venv."""
+    return '. {}; '.format(os.path.join(venv_path, 'bin', 'activate'))
+
+
+def create_venv(venv_path):
+    """Create venv with checkbox's dependencies."""
     subprocess.run(
         ['./mk-venv', venv_path],
         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    manage_py = 'benchmarking-provider/manage.py'
+
+
+def prepare_venv(venv_path):
+    """
+    Develop the checkbox tree in venv.
+
+    A venv taken from the cache may have been developed from another tree,
+    so this is done no matter whether the venv is new.
+    """
     subprocess.run(
-        ". {}; {} develop -d $PROVIDERPATH".format(
-            os.path.join(venv_path, 'bin', 'activate'), manage_py),
-        shell=True, stdout=subprocess.DEVNULL, check=True)
+        activate(venv_path) + "python3 setup.py develop --no-deps",
+        shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        check=True)
+
+
+class Workspace:
+    """
+    What one benchmarking worker runs checkbox with.
+
+    Every workspace has its own copy of the benchmarking provider, its own
+    PROVIDERPATH and XDG directories and its own slave port, so runs in
+    different workspaces can go on at the same time.  With `cpus` set, the
+    runs are pinned to those CPUs.
+    """
+    def __init__(self, root, venv, port, cpus=None):
+        self.root = root
+        self.venv = venv
+        self.port = port
+        self.cpus = cpus
+        self.provider_dir = os.path.join(root, 'benchmarking-provider')
+        self.synthetic_units = os.path.join(
+            self.provider_dir, 'units', 'synthetic.pxu')
+        providers = os.path.join(root, 'providers')
+        self.env = dict(
+            os.environ, PROVIDERPATH=providers,
+            XDG_CACHE_HOME=os.path.join(root, 'cache'),
+            XDG_CONFIG_HOME=os.path.join(root, 'config'),
+            XDG_DATA_HOME=os.path.join(root, 'data'))
+
+    def activate(self):
+        """
+        Like activate(), but keeping this workspace's directories.
+
+        The venv's activate script sets PROVIDERPATH of its own, which would
+        make all the workspaces share one provider directory.
+        """
+        return activate(self.venv) + 'export {}; '.format(' '.join(
+            '{}={}'.format(name, shlex.quote(self.env[name]))
+            for name in ISOLATED_VARIABLES))
+
+    def setup(self):
+        """Copy the provider and develop it in this workspace."""
+        shutil.copytree(PROVIDER_DIR, self.provider_dir, ignore=(
+            shutil.ignore_patterns('launcher-*', 'synthetic.pxu',
+                                   '__pycache__')))
+        os.makedirs(self.env['PROVIDERPATH'])
+        subprocess.run(
+            self.activate() + "{} develop -d $PROVIDERPATH".format(
+                os.path.join(self.provider_dir, 'manage.py')),
+            shell=True, stdout=subprocess.DEVNULL, check=True, env=self.env)
+
+    def pin(self):
+        """Pin the calling thread, and so what it starts, to our CPUs."""
+        if self.cpus:
+            # on Linux, pid 0 is the calling thread and child processes
+            # inherit the affinity of the thread that forked them
+            os.sched_setaffinity(0, self.cpus)
+
+
+def smt_siblings(cpu):
+    """Return the hardware threads sharing a core with `cpu`, itself included."""
+    path = '/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list'.format(
+        cpu)
+    try:
+        with open(path, 'rt') as f:
+            text = f.read().strip()
+    except OSError:
+        return {cpu}
+    siblings = set()
+    for part in text.split(','):
+        low, sep, high = part.partition('-')
+        siblings.update(range(int(low), int(high) + 1) if sep else [int(low)])
+    return siblings
+
+
+def cpu_sets(count=None, idle_siblings=False):
+    """
+    Split the CPUs we may run on into `count` disjoint sets.
+
+    Without `count`, every CPU gets a set of its own.  With `idle_siblings`,
+    only one hardware thread of every core is used, so that no two sets
+    share a core's execution units.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if idle_siblings:
+        cpus = [cpu for cpu in cpus
+                if cpu == min(smt_siblings(cpu) & set(cpus))]
+    count = count or len(cpus)
+    if count > len(cpus):
+        raise SystemExit("Cannot pin {} workers to {} CPUs".format(
+            count, len(cpus)))
+    size = len(cpus) // count
+    return [set(cpus[i * size:(i + 1) * size]) for i in range(count)]
+
+
+@contextlib.contextmanager
+def trace_file(enabled):
+    """Provide a fresh path for a phase trace, or None if not `enabled`."""
+    if not enabled:
+        yield None
+        return
+    fd, path = tempfile.mkstemp(prefix='cbox-trace-', suffix='.jsonl')
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        os.unlink(path)
+
 
+def trace_env(trace_path, env):
+    """Extend `env` so that checkbox-cli records its phases in a file."""
+    if not trace_path:
+        return env
+    env = dict(env)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [TRACE_DIR, env.get('PYTHONPATH')] if p)
+    env['CHECKBOX_TRACE_FILE'] = trace_path
+    return env
 
-def run_via_remote(launcher):
-    """Launch a slave and run `launcher` via master on that slave."""
+
+def read_phases(trace_path, start, stop):
+    """
+    Sum up self times of the traced calls, per phase.
+
+    Only calls that started between `start` and `stop` are counted.  Whatever
+    is left of the measured time is reported as 'other'.
+    """
+    phases = dict()
+    with open(trace_path, 'rt') as f:
+        for line in f:
+            span = json.loads(line)
+            if start <= span['start'] <= stop:
+                phases[span['phase']] = phases.get(
+                    span['phase'], 0.0) + span['self']
+    phases['other'] = max(stop - start - sum(phases.values()), 0.0)
+    return phases
+
+
+def exit_code(status):
+    """Translate a wait status the way Popen.returncode does."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_command(command, env=None):
+    """
+    Run shell `command`, returning its start and stop times and rusage.
+
+    The rusage comes from wait4(), so it covers the command and all of the
+    processes it waited for, and nothing else the harness started.  Raise
+    CalledProcessError if the command fails.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        command, shell=True, stderr=subprocess.STDOUT, env=env)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    stop = time.perf_counter()
+    proc.returncode = exit_code(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return start, stop, rusage
+
+
+def stop_process(proc, sig, timeout=30):
+    """
+    Send `sig` to the process group of `proc` and reap it.
+
+    The process is killed if it is still around after `timeout` seconds.
+    Return its rusage, or None if it has already been reaped.
+    """
+    deadline = time.monotonic() + timeout
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(os.getpgid(proc.pid), sig)
     try:
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+                _, status, rusage = os.wait4(proc.pid, 0)
+                break
+            time.sleep(0.05)
+    except ChildProcessError:
+        return None
+    proc.returncode = exit_code(status)
+    return rusage
+
+
+def resource_usage(rusage):
+    """
+    Pick the interesting fields of a struct rusage.
+
+    I/O is what actually hit block devices, reads served from the page cache
+    are not counted.
+    """
+    return {
+        'maxrss': rusage.ru_maxrss * 1024,  # Linux reports KiB
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'nvcsw': rusage.ru_nvcsw,
+        'nivcsw': rusage.ru_nivcsw,
+        'read_bytes': rusage.ru_inblock * 512,
+        'write_bytes': rusage.ru_oublock * 512,
+    }
+
+
+def make_sample(start, stop, trace_path=None, resources=None):
+    sample = {'duration': stop - start}
+    if trace_path:
+        sample['phases'] = read_phases(trace_path, start, stop)
+    if resources:
+        sample['resources'] = {
+            process: resource_usage(rusage)
+            for process, rusage in resources.items() if rusage is not None}
+    return sample
+
+
+def checkbox_cli(profile_path=None):
+    """Shell command running checkbox-cli, under cProfile if asked to."""
+    if not profile_path:
+        return 'checkbox-cli'
+    return 'python3 -m cProfile -o {} "$(command -v checkbox-cli)"'.format(
+        profile_path)
+
+
+def port_open(port, host='localhost'):
+    """Tell whether something accepts connections on `port`."""
+    try:
+        with socket.create_connection((host, port), timeout=0.1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(port, proc, timeout):
+    """Wait until `proc` listens on `port`, failing after `timeout` seconds."""
+    deadline = time.perf_counter() + timeout
+    while not port_open(port):
+        if proc.poll() is not None:
+            raise SystemExit("Slave died before it started listening")
+        if time.perf_counter() > deadline:
+            raise SystemExit(
+                "Slave did not listen on port {} within {}s".format(
+                    port, timeout))
+        time.sleep(0.01)
+
+
+def run_via_remote(launcher, workspace, trace=False, profile=None,
+                   slave_timeout=30, rpc_stats=False):
+    """
+    Launch a slave and run `launcher` via master on that slave.
+
+    The master is only started, and timed, once the slave accepts
+    connections; how long that took is reported as 'slave_startup'.  With
+    `profile` set, master and slave run under cProfile and write their stats
+    to `profile`-master.pstats and `profile`-slave.pstats.  With `rpc_stats`
+    set, the master talks to the slave through a LoopbackProxy and the
+    traffic is reported as 'rpc'.
+    """
+    with trace_file(trace) as trace_path:
+        return _run_via_remote(launcher, workspace, trace_path, profile,
+                               slave_timeout, rpc_stats)
+
+
+def _run_via_remote(launcher, workspace, trace_path, profile, slave_timeout,
+                    rpc_stats):
+    master_profile = slave_profile = None
+    if profile:
+        master_profile = profile + '-master.pstats'
+        slave_profile = profile + '-slave.pstats'
+    if port_open(workspace.port):
+        raise SystemExit("Something already listens on port {}".format(
+            workspace.port))
+    try:
+        # exec, so that the slave's rusage isn't lost with the shell
+        spawned = time.perf_counter()
         slave_proc = subprocess.Popen(
-            '. venv/bin/activate; checkbox-cli slave',
-            shell=True, start_new_session=True)
+            workspace.activate() + 'exec {} slave --port {}'.format(
+                checkbox_cli(slave_profile), workspace.port),
+            shell=True, start_new_session=True,
+            env=trace_env(trace_path, workspace.env))
     except subprocess.CalledProcessError:
         raise SystemExit("Failed to run the slave")
+    resources = dict()
     with contextlib.ExitStack() as stack:
         def kill_slave(*_):
-            with contextlib.suppress(ProcessLookupError):
-                os.killpg(os.getpgid(slave_proc.pid), signal.SIGTERM)
+            # cProfile only writes its stats when the slave exits cleanly,
+            # which it does on KeyboardInterrupt
+            resources['slave'] = stop_process(
+                slave_proc, signal.SIGINT if profile else signal.SIGTERM)
         stack.push(kill_slave)
+        wait_for_port(workspace.port, slave_proc, slave_timeout)
+        slave_startup = time.perf_counter() - spawned
+        master_port = workspace.port
+        if rpc_stats:
+            proxy = stack.enter_context(
+                rpc_proxy.LoopbackProxy(workspace.port))
+            master_port = proxy.port
         try:
-            start = time.time()
-            subprocess.run(
-                ". venv/bin/activate; checkbox-cli master localhost {}".format(
-                    launcher), shell=True,
-                stderr=subprocess.STDOUT, check=True)
-            stop = time.time()
-        except subprocess.CalledProcessError as exc:
-            print(exc.stdout.decode(sys.stdout.encoding))
+            start, stop, resources['master'] = run_command(
+                workspace.activate() +
+                "exec {} master localhost {} --port {}".format(
+                    checkbox_cli(master_profile), launcher, master_port),
+                env=workspace.env)
+        except subprocess.CalledProcessError:
             raise SystemExit("Failed to remotely run launcher {}".format(
                 launcher))
         if slave_proc.poll() is not None:
             raise SystemExit("Slave died by its own. Benchmarking failed")
-    return stop - start
+    sample = make_sample(start, stop, trace_path, resources)
+    sample['slave_startup'] = slave_startup
+    if rpc_stats:
+        sample['rpc'] = proxy.stats()
+    return sample
+
+
+def run_locally(launcher, workspace, trace=False, profile=None):
+    """
+    Launch given launcher locally.
+
+    With `profile` set, checkbox-cli runs under cProfile and writes its stats
+    to `profile`.pstats.
+    """
+    profile_path = profile + '.pstats' if profile else None
+    with trace_file(trace) as trace_path:
+        try:
+            start, stop, rusage = run_command(
+                workspace.activate() + "exec {} {}".format(
+                    checkbox_cli(profile_path), launcher),
+                env=trace_env(trace_path, workspace.env))
+        except subprocess.CalledProcessError:
+            raise SystemExit("Failed to remotely run launcher {}".format(
+                launcher))
+        return make_sample(start, stop, trace_path, {'local': rusage})
+
+
+def collapsed_stacks(stats, min_weight=1e-6, max_depth=64):
+    """
+    Approximate collapsed stacks ("outer;inner;leaf microseconds").
+
+    cProfile only records caller-callee pairs, not whole stacks, so the own
+    time of every function is spread over the paths leading to it, in
+    proportion to the time each caller accounts for.
+    """
+    def name(func):
+        filename, line, funcname = func
+        return '{}:{}({})'.format(os.path.basename(filename), line, funcname)
+
+    stacks = collections.Counter()
+
+    def walk(func, weight, path):
+        callers = stats.stats[func][4]
+        if not callers or len(path) >= max_depth:
+            stacks[';'.join(name(f) for f in reversed(path))] += weight
+            return
+        # cProfile stores (cc, nc, tt, ct) per caller; plain profile just nc
+        shares = {caller: edge[2] if isinstance(edge, tuple) else edge
+                  for caller, edge in callers.items()}
+        total = sum(shares.values())
+        for caller, share in shares.items():
+            share = share / total if total else 1 / len(shares)
+            if weight * share < min_weight:
+                continue
+            if caller in path:
+                stacks[';'.join(name(f) for f in reversed(path))] += (
+                    weight * share)
+                continue
+            walk(caller, weight * share, path + [caller])
+
+    for func, (_, _, tottime, _, _) in stats.stats.items():
+        if tottime >= min_weight:
+            walk(func, tottime, [func])
+    return ['{} {}'.format(stack, round(weight * 1e6))
+            for stack, weight in sorted(stacks.items())
+            if round(weight * 1e6)]
+
+
+def report_profile(pstats_path, top):
+    """Print the top cumulative hotspots and write collapsed stacks."""
+    if not os.path.exists(pstats_path):
+        print("No profile written to {}".format(pstats_path))
+        return
+    stats = pstats.Stats(pstats_path)
+    print("=" * 20, pstats_path, "=" * 20)
+    stats.sort_stats('cumulative').print_stats(top)
+    collapsed_path = os.path.splitext(pstats_path)[0] + '.collapsed'
+    with open(collapsed_path, 'wt') as f:
+        f.write('\n'.join(collapsed_stacks(stats)) + '\n')
+    print("Collapsed stacks written to {}".format(collapsed_path))
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples`, interpolating linearly."""
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * pct / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def relative_standard_error(samples):
+    """Return the standard error of the mean, relative to the mean."""
+    if len(samples) < 2:
+        return math.inf
+    mean = statistics.mean(samples)
+    if not mean:
+        return math.inf
+    return statistics.stdev(samples) / math.sqrt(len(samples)) / mean
+
+
+def summarize(samples):
+    """Compute descriptive statistics and a 95% CI of the mean."""
+    n = len(samples)
+    mean = statistics.mean(samples)
+    stdev = statistics.stdev(samples) if n > 1 else 0.0
+    t = T_95[n - 2] if 1 < n <= len(T_95) + 1 else Z_95
+    half_width = t * stdev / math.sqrt(n)
+    return {
+        'n': n,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': mean,
+        'stdev': stdev,
+        'p95': percentile(samples, 95),
+        'ci95': (mean - half_width, mean + half_width),
+        'rse': relative_standard_error(samples),
+    }
+
+
+def measure(run, launcher, warmup, repeat, target_rse=None, max_repeat=None):
+    """
+    Run `run(launcher)` `warmup` times, then collect measured samples.
+
+    Without `target_rse` exactly `repeat` samples are collected.  Otherwise
+    `repeat` is the minimum and runs continue until the relative standard
+    error of the mean duration drops below `target_rse`, or `max_repeat` is
+    reached.
+    """
+    for _ in range(warmup):
+        run(launcher)
+    samples = []
+    while len(samples) < repeat or (
+            target_rse is not None and len(samples) < max_repeat and
+            relative_standard_error(
+                [s['duration'] for s in samples]) > target_rse):
+        samples.append(run(launcher))
+    return samples
+
+
+def summarize_phases(samples):
+    """Median time of every traced phase across `samples`."""
+    phases = dict()
+    for sample in samples:
+        for phase, duration in sample.get('phases', {}).items():
+            phases.setdefault(phase, []).append(duration)
+    return {phase: statistics.median(durations)
+            for phase, durations in phases.items()}
+
+
+def summarize_resources(samples):
+    """
+    Resource usage of every process across `samples`.
+
+    Peak RSS is the highest seen in any run, everything else is the median.
+    """
+    usages = dict()
+    for sample in samples:
+        for process, usage in sample.get('resources', {}).items():
+            for metric, value in usage.items():
+                usages.setdefault(process, dict()).setdefault(
+                    metric, []).append(value)
+    return {process: {metric: max(values) if metric == 'maxrss' else
+                      statistics.median(values)
+                      for metric, values in metrics.items()}
+            for process, metrics in usages.items()}
+
+
+def summarize_rpc(samples):
+    """Median of every traffic statistic across `samples`."""
+    rpc = [sample['rpc'] for sample in samples if 'rpc' in sample]
+    if not rpc:
+        return None
+    return {stat: statistics.median(stats[stat] for stats in rpc)
+            for stat in rpc[0]}
+
+
+def print_summary(name, summary, phases=None, resources=None,
+                  slave_startup=None, rpc=None):
+    print('{:30} n={:<3} min {:8.3f}  median {:8.3f}  mean {:8.3f}  '
+          'stdev {:7.3f}  p95 {:8.3f}  95% CI [{:.3f}, {:.3f}]'.format(
+              name, summary['n'], summary['min'], summary['median'],
+              summary['mean'], summary['stdev'], summary['p95'],
+              *summary['ci95']))
+    if slave_startup:
+        print('    {:26} median {:8.3f}  p95 {:8.3f}  (not in the above)'
+              .format('slave startup', slave_startup['median'],
+                      slave_startup['p95']))
+    total = sum((phases or {}).values())
+    for phase, duration in sorted((phases or {}).items(),
+                                  key=lambda p: p[1], reverse=True):
+        print('    {:26} median {:8.3f}  ({:5.1f}%)'.format(
+            phase, duration, 100 * duration / total if total else 0))
+    for process, usage in sorted((resources or {}).items()):
+        print('    {:8} peak RSS {:8.1f} MiB  user {:8.3f}  sys {:7.3f}  '
+              'ctx sw {:.0f}/{:.0f}  read {:.1f} MiB  write {:.1f} MiB'.format(
+                  process, usage['maxrss'] / 2**20, usage['utime'],
+                  usage['stime'], usage['nvcsw'], usage['nivcsw'],
+                  usage['read_bytes'] / 2**20, usage['write_bytes'] / 2**20))
+    if rpc:
+        print('    {:8} {:.0f} calls  median {:.2f} ms  p95 {:.2f} ms  '
+              'total {:.3f}  sent {:.1f} KiB in {:.0f}  '
+              'received {:.1f} KiB in {:.0f}'.format(
+                  'rpc', rpc['calls'], rpc['call_median'] * 1000,
+                  rpc['call_p95'] * 1000, rpc['call_time'],
+                  rpc['bytes_sent'] / 1024, rpc['messages_sent'],
+                  rpc['bytes_received'] / 1024, rpc['messages_received']))
+
+
+def print_remote_overhead(results, scenarios):
+    """Put the remote-local difference next to the time spent in calls."""
+    print('{:30} {:>8} {:>8} {:>8} {:>7} {:>9} {:>10}'.format(
+        'remote overhead', 'local', 'remote', 'delta', 'calls',
+        'call time', 'KiB moved'))
+    for scenario in scenarios:
+        local = results.get('local-' + scenario)
+        remote = results.get('remote-' + scenario)
+        if not local or not remote or not remote.get('rpc'):
+            continue
+        rpc = remote['rpc']
+        print('{:30} {:8.3f} {:8.3f} {:8.3f} {:7.0f} {:9.3f} {:10.1f}'.format(
+            scenario, local['duration']['median'],
+            remote['duration']['median'],
+            remote['duration']['median'] - local['duration']['median'],
+            rpc['calls'], rpc['call_time'],
+            (rpc['bytes_sent'] + rpc['bytes_received']) / 1024))
+
+def scaling_curves(results, loads, x='jobs'):
+    """
+    Median duration of the sweep as a function of `x`, per mode.
+
+    Every combination of the parameters that `x` does not depend on makes a
+    separate curve.  The slope between neighbouring points is taken on a
+    log-log scale, so 1 means linear growth and anything above that means the
+    duration grows faster than `x`.
+    """
+    varying = {'jobs': ['templates', 'records']}.get(x, [x])
+    fixed = [param for param in synthetic.Load._fields if param not in varying]
+    curves = dict()
+    for scenario, load in loads.items():
+        for mode in ['local', 'remote']:
+            result = results.get('{}-{}'.format(mode, scenario))
+            if result is None:
+                continue
+            key = (mode, ' '.join('{}={}'.format(param, getattr(load, param))
+                                  for param in fixed))
+            value = synthetic.job_count(load) if x == 'jobs' else getattr(
+                load, x)
+            curves.setdefault(key, []).append(
+                (value, scenario, load, result['duration']))
+    rows = []
+    for (mode, curve), points in sorted(curves.items()):
+        previous = None
+        for value, scenario, load, duration in sorted(
+                points, key=lambda p: p[0]):
+            slope = None
+            if previous and 0 < previous[0] < value and previous[1] > 0:
+                slope = (math.log(duration['median'] / previous[1]) /
+                         math.log(value / previous[0]))
+            rows.append(dict(
+                mode=mode, curve=curve, scenario=scenario, x=value,
+                jobs=synthetic.job_count(load), median=duration['median'],
+                ci95_low=duration['ci95'][0], ci95_high=duration['ci95'][1],
+                slope=slope, **load._asdict()))
+            previous = (value, duration['median'])
+    return rows
+
+
+def print_scaling(rows, x, superlinear=1.15):
+    """Print scaling curves, marking the superlinear stretches."""
+    curve = None
+    for row in rows:
+        if (row['mode'], row['curve']) != curve:
+            curve = (row['mode'], row['curve'])
+            print('{} {}'.format(*curve))
+            print('    {:>10} {:>10} {:>12} {:>7}'.format(
+                x, 'median', 's per ' + x, 'slope'))
+        slope = '' if row['slope'] is None else '{:7.2f}'.format(row['slope'])
+        print('    {:10} {:10.3f} {:12.6f} {:>7}{}'.format(
+            row['x'], row['median'],
+            row['median'] / row['x'] if row['x'] else math.nan, slope,
+            '  superlinear' if row['slope'] and row['slope'] > superlinear
+            else ''))
 
 
-def run_locally(launcher):
-    """Launch given launcher locally."""
+def write_scaling_csv(rows, path):
+    fields = ['mode', 'curve', 'scenario'] + list(synthetic.Load._fields) + [
+        'jobs', 'x', 'median', 'ci95_low', 'ci95_high', 'slope']
+    with open(path, 'wt', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_scenario(scenario, launcher, workspace, args, profile_dir):
+    """Profile or measure `launcher` locally and remotely."""
+    target_rse = args.target_rse if args.auto else None
+    results = dict()
+    for mode, run in [('local', run_locally), ('remote', run_via_remote)]:
+        run = functools.partial(run, workspace=workspace)
+        if mode == 'remote':
+            run = functools.partial(run, slave_timeout=args.slave_timeout,
+                                    rpc_stats=args.rpc_stats)
+        if args.profile:
+            profile = os.path.join(profile_dir, '{}-{}'.format(
+                mode, scenario))
+            run(launcher, profile=profile)
+            for suffix in (['.pstats'] if mode == 'local' else
+                           ['-master.pstats', '-slave.pstats']):
+                report_profile(profile + suffix, args.profile_top)
+            continue
+        run = functools.partial(run, trace=args.phases)
+        samples = measure(run, launcher, args.warmup, args.repeat,
+                          target_rse, args.max_repeat)
+        results['{}-{}'.format(mode, scenario)] = {
+            'mode': mode,
+            'scenario': scenario,
+            'samples': samples,
+            'duration': summarize([s['duration'] for s in samples]),
+            'phases': summarize_phases(samples),
+            'resources': summarize_resources(samples),
+        }
+        if mode == 'remote':
+            results['{}-{}'.format(mode, scenario)].update(
+                slave_startup=summarize([s['slave_startup'] for s in samples]),
+                rpc=summarize_rpc(samples))
+    return results
+
+
+def run_task(scenario, load, workspaces, args, profile_dir):
+    """Run `scenario` in the first free workspace from `workspaces`."""
+    workspace = workspaces.get()
+    try:
+        workspace.pin()
+        if load:
+            launcher = os.path.join(workspace.root, 'launcher-' + scenario)
+            synthetic.write_load(load, workspace.synthetic_units, launcher)
+        else:
+            launcher = os.path.join(
+                PROVIDER_DIR, 'launcher-{}'.format(scenario))
+        return run_scenario(scenario, launcher, workspace, args, profile_dir)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(workspace.synthetic_units)
+        workspaces.put(workspace)
+
+
+def cpu_name():
+    with contextlib.suppress(OSError):
+        with open('/proc/cpuinfo', 'rt') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    return platform.processor() or platform.machine()
+
+
+def git_commit(path):
+    """Return the commit checked out at `path`, or None outside of git."""
     try:
-        start = time.time()
-        subprocess.run(". venv/bin/activate; checkbox-cli {}".format(
-            launcher), shell=True, stderr=subprocess.STDOUT, check=True)
-        stop = time.time()
-    except subprocess.CalledProcessError as exc:
-        print(exc.stdout.decode(sys.stdout.encoding))
-        raise SystemExit("Failed to remotely run launcher {}".format(launcher))
-    return stop - start
+        return subprocess.check_output(
+            ['git', '-C', path, 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def host_info():
+    return {
+        'name': platform.node(),
+        'cpu': cpu_name(),
+        'cpus': os.cpu_count(),
+        'platform': platform.platform(),
+    }
+
+
+def environment_info(bench_dir, venv):
+    """Describe what the results are measured on and with."""
+    out = subprocess.run(
+        ['sh', '-c', activate(venv) + 'exec python3 -'],
+        input=VERSIONS_SCRIPT.encode(), stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL).stdout.decode().split()
+    python_version, checkbox_version = (out + ['unknown', 'unknown'])[:2]
+    return {
+        'host': host_info(),
+        'python': python_version,
+        'checkbox': checkbox_version,
+        'commit': git_commit(bench_dir),
+    }
+
+
+def json_safe(value):
+    """Replace the infinities JSON has no place for with None."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def write_results(path, results, environment, settings, loads):
+    """Write one JSON line per measured mode and scenario."""
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with open(path, 'wt') as f:
+        for name, result in results.items():
+            record = {
+                'format': RESULTS_FORMAT,
+                'timestamp': timestamp,
+                'scenario': result['scenario'],
+                'mode': result['mode'],
+                'settings': settings,
+                'samples': result['samples'],
+                'summary': result['duration'],
+            }
+            record.update(environment)
+            if result['scenario'] in loads:
+                record['load'] = loads[result['scenario']]._asdict()
+            f.write(json.dumps(json_safe(record)) + '\n')
+
+
+def read_results(path):
+    """Return the last record of every (mode, scenario) in `path`."""
+    records = dict()
+    with open(path, 'rt') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                raise SystemExit("{}:{}: {}".format(path, lineno, exc))
+            if record.get('format', 0) > RESULTS_FORMAT:
+                raise SystemExit(
+                    "{}:{}: results format {} is newer than this "
+                    "benchmark.py understands ({})".format(
+                        path, lineno, record.get('format'), RESULTS_FORMAT))
+            records[record['mode'], record['scenario']] = record
+    return records
+
+
+def u_distribution(m, n):
+    """
+    Count the orderings of m + n distinct values by their U statistic.
+
+    U is the number of (first group, second group) pairs where the value from
+    the first group is the larger one.
+    """
+    # counts[j] holds the distribution for i values of the first group and j
+    # of the second; the largest value either comes from the first group,
+    # beating all j of the second, or from the second group
+    counts = [[1] for j in range(n + 1)]
+    for i in range(1, m + 1):
+        new_counts = [[1]]
+        for j in range(1, n + 1):
+            dist = [0] * (i * j + 1)
+            for u, c in enumerate(counts[j]):
+                dist[u + j] += c
+            for u, c in enumerate(new_counts[j - 1]):
+                dist[u] += c
+            new_counts.append(dist)
+        counts = new_counts
+    return counts[n]
+
+
+def mann_whitney(baseline, current):
+    """
+    One-sided Mann-Whitney U test of `current` being larger than `baseline`.
+
+    Return the U statistic of `current` and the p-value.  The p-value is
+    exact for small samples without ties, otherwise it comes from the normal
+    approximation with tie and continuity corrections.
+    """
+    n1, n2 = len(current), len(baseline)
+    total = n1 + n2
+    values = sorted([(v, True) for v in current] +
+                    [(v, False) for v in baseline])
+    rank_sum = 0.0
+    tie_term = 0
+    i = 0
+    while i < total:
+        j = i
+        while j + 1 < total and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        rank_sum += rank * sum(1 for _, cur in values[i:j + 1] if cur)
+        tie_term += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    u = rank_sum - n1 * (n1 + 1) / 2
+    if not tie_term and total <= 40:
+        dist = u_distribution(n1, n2)
+        return u, sum(dist[math.ceil(u):]) / sum(dist)
+    variance = n1 * n2 / 12 * (total + 1 - tie_term / (total * (total - 1)))
+    if not variance:
+        return u, 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return u, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare_results(baseline, current, threshold, alpha):
+    """
+    Compare the durations of every scenario in both result sets.
+
+    A scenario regressed if its median got slower by more than `threshold`
+    and the Mann-Whitney test says so with significance `alpha`.
+    """
+    rows = []
+    for key in sorted(set(baseline) | set(current)):
+        if key not in baseline or key not in current:
+            rows.append((key, None, None, None, 'only in {}'.format(
+                'baseline' if key in baseline else 'current')))
+            continue
+        before = [s['duration'] for s in baseline[key]['samples']]
+        after = [s['duration'] for s in current[key]['samples']]
+        change = statistics.median(after) / statistics.median(before) - 1
+        _, p_slower = mann_whitney(before, after)
+        _, p_faster = mann_whitney(after, before)
+        if change > threshold and p_slower < alpha:
+            status = 'REGRESSION'
+        elif change < -threshold and p_faster < alpha:
+            status = 'improved'
+        else:
+            status = 'ok'
+        rows.append((key, statistics.median(before), statistics.median(after),
+                     (change, min(p_slower, p_faster)), status))
+    return rows
+
+
+def compare_main(argv):
+    """Entry point of the compare subcommand."""
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py compare',
+        description="Test benchmark results against a baseline.")
+    parser.add_argument('baseline', help="results written with --output")
+    parser.add_argument('current', help="results written with --output")
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help="relative slowdown of the median that counts "
+                             "as a regression (default: 0.05)")
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help="significance level of the Mann-Whitney test "
+                             "(default: 0.05)")
+    args = parser.parse_args(argv)
+    baseline = read_results(args.baseline)
+    current = read_results(args.current)
+    hosts = {json.dumps(record.get('host'), sort_keys=True)
+             for record in list(baseline.values()) + list(current.values())}
+    if len(hosts) > 1:
+        print("Warning: the results come from different hosts")
+    regressions = 0
+    for (mode, scenario), before, after, change, status in compare_results(
+            baseline, current, args.threshold, args.alpha):
+        name = '{}-{}'.format(mode, scenario)
+        if before is None:
+            print('{:30} {}'.format(name, status))
+            continue
+        print('{:30} {:8.3f} -> {:8.3f}  {:+7.1%}  p={:.3f}  {}'.format(
+            name, before, after, change[0], change[1], status))
+        regressions += status == 'REGRESSION'
+    if regressions:
+        raise SystemExit("{} scenario(s) regressed".format(regressions))
 
 
 def main():
     """Entry point."""
-    with tempfile.TemporaryDirectory(prefix='cbox-bench') as tmpdir:
+    if sys.argv[1:2] == ['compare']:
+        return compare_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        epilog="Run 'benchmark.py compare -h' for comparing results.")
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='scenario',
+        help="scenarios to run (default: all the launchers found)")
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="unmeasured runs per scenario (default: 1)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="measured runs per scenario; the minimum with "
+                             "--auto (default: 5)")
+    parser.add_argument('--auto', action='store_true',
+                        help="repeat until the relative standard error of "
+                             "the mean drops below --target-rse")
+    parser.add_argument('--target-rse', type=float, default=0.02,
+                        help="relative standard error to reach with --auto "
+                             "(default: 0.02)")
+    parser.add_argument('--max-repeat', type=int, default=50,
+                        help="most measured runs per scenario with --auto "
+                             "(default: 50)")
+    parser.add_argument('--phases', action='store_true',
+                        help="trace checkbox-cli and break every run down "
+                             "into phases")
+    parser.add_argument('--profile', action='store_true',
+                        help="instead of measuring, run every scenario once "
+                             "under cProfile and report the hotspots")
+    parser.add_argument('--profile-dir', default='profiles',
+                        help="where to save .pstats and .collapsed files "
+                             "(default: profiles)")
+    parser.add_argument('--profile-top', type=int, default=20,
+                        help="number of hotspots to print (default: 20)")
+    parser.add_argument('--sweep', action='append', default=[],
+                        metavar='PARAM=V1,V2,...',
+                        help="instead of the scenarios, run synthetic loads "
+                             "for every combination of the values given; "
+                             "PARAM is one of {}".format(
+                                 ', '.join(synthetic.Load._fields)))
+    parser.add_argument('--sweep-x', default='jobs',
+                        choices=['jobs'] + list(synthetic.Load._fields),
+                        help="what to plot the sweep's durations against "
+                             "(default: jobs)")
+    parser.add_argument('--sweep-csv', metavar='PATH',
+                        help="also write the scaling curves to a CSV file")
+    parser.add_argument('--output', metavar='PATH',
+                        help="save the samples and what they were measured "
+                             "on as JSON lines")
+    parser.add_argument('--venv-cache', metavar='DIR',
+                        help="where to keep venvs between runs (default: {})"
+                        .format(venv_cache.default_cache_dir()))
+    parser.add_argument('--venv-cache-size', default='10G',
+                        type=venv_cache.parse_size,
+                        help="evict least recently used venvs above this "
+                             "size (default: 10G)")
+    parser.add_argument('--no-venv-cache', action='store_true',
+                        help="build a fresh venv for this run only")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="scenarios to run at the same time (default: 1)")
+    parser.add_argument('--pin', action='store_true',
+                        help="pin every worker to its own share of the CPUs")
+    parser.add_argument('--slave-timeout', type=float, default=30,
+                        help="seconds to wait for the slave to listen "
+                             "(default: 30)")
+    parser.add_argument('--rpc-stats', action='store_true',
+                        help="count and time the traffic between master and "
+                             "slave, through a proxy that adds a little "
+                             "latency of its own")
+    parser.add_argument('--base-port', type=int, default=18871,
+                        help="slave port of the first worker, the others "
+                             "use the following ones (default: 18871)")
+    args = parser.parse_args()
+    if args.sweep and args.scenarios:
+        parser.error("--sweep runs synthetic loads, not the scenarios given")
+    try:
+        loads = collections.OrderedDict(
+            ('synthetic-' + synthetic.load_tag(load), load)
+            for load in synthetic.grid_points(synthetic.parse_grid(
+                args.sweep))) if args.sweep else dict()
+    except ValueError as exc:
+        raise SystemExit(exc)
+
+    cwd = os.getcwd()
+    with contextlib.ExitStack() as stack:
+        tmpdir = stack.enter_context(
+            tempfile.TemporaryDirectory(prefix='cbox-bench'))
         bench_dir = os.path.split(os.path.abspath(__file__))[0]
         os.chdir(bench_dir)
         launchers = glob.glob('benchmarking-provider/launcher-*')
         scenarios = [s.replace(
             'benchmarking-provider/launcher-', '') for s in launchers]
+        for scenario in args.scenarios:
+            if scenario not in scenarios:
+                raise SystemExit('Unknown scenario: {}'.format(scenario))
+        scenarios = list(loads) or args.scenarios or scenarios
         results = dict()
-        prepare_venv(os.path.join(tmpdir, 'venv'))
-        for scenario in scenarios:
-            local_result = run_locally(os.path.join(
-                bench_dir, 'benchmarking-provider',
-                'launcher-{}'.format(scenario)))
-            remote_result = run_via_remote(os.path.join(
-                bench_dir, 'benchmarking-provider',
-                'launcher-{}'.format(scenario)))
-            results['local-{}'.format(scenario)] = local_result
-            results['remote-{}'.format(scenario)] = remote_result
-        pprint(results)
+        # relative to where we were started, not to bench_dir
+        profile_dir = os.path.join(cwd, args.profile_dir)
+        if args.profile:
+            os.makedirs(profile_dir, exist_ok=True)
+        if args.no_venv_cache:
+            venv = os.path.join(tmpdir, 'venv')
+            create_venv(venv)
+        else:
+            cache_dir = args.venv_cache and os.path.join(cwd, args.venv_cache)
+            venv = stack.enter_context(venv_cache.VenvCache(
+                cache_dir, args.venv_cache_size).acquire(
+                    bench_dir, create_venv))
+        prepare_venv(venv)
+        cpus = cpu_sets(args.jobs) if args.pin else [None] * args.jobs
+        workspaces = queue.Queue()
+        for worker in range(args.jobs):
+            workspace = Workspace(
+                os.path.join(tmpdir, 'worker-{}'.format(worker)), venv,
+                args.base_port + worker, cpus[worker])
+            workspace.setup()
+            workspaces.put(workspace)
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(run_task, scenario, loads.get(scenario),
+                                   workspaces, args, profile_dir)
+                       for scenario in scenarios]
+            for future in futures:
+                try:
+                    results.update(future.result())
+                except BaseException:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+        for name, result in results.items():
+            print_summary(name, result['duration'], result['phases'],
+                          result['resources'], result.get('slave_startup'),
+                          result.get('rpc'))
+        if args.rpc_stats:
+            print_remote_overhead(results, scenarios)
+        if loads and results:
+            rows = scaling_curves(results, loads, args.sweep_x)
+            print_scaling(rows, args.sweep_x)
+            if args.sweep_csv:
+                write_scaling_csv(rows, os.path.join(cwd, args.sweep_csv))
+        if args.output and results:
+            settings = {'warmup': args.warmup, 'repeat': args.repeat,
+                        'target_rse': args.target_rse if args.auto else None,
+                        'phases': args.phases}
+            write_results(os.path.join(cwd, args.output), results,
+                          environment_info(bench_dir, venv), settings, loads)
 
 
 if __name__ == '__main__':
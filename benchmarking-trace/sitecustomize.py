@@ -0,0 +1,106 @@
+# Copyright 2020 Canonical Ltd.
+# Written by:
+#   Maciej Kisielewski <maciej.kisielewski@canonical.com>
+#
+# Checkbox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# Checkbox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Checkbox.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Phase tracing hook for benchmark.py.
+
+benchmark.py puts this directory on PYTHONPATH of the checkbox-cli processes
+it measures.  When CHECKBOX_TRACE_FILE is set, the plainbox methods that mark
+the stages of a run are wrapped, and each call is appended to that file as a
+JSON line with its phase, start and end (time.perf_counter()) and its self
+time, that is the time not spent in nested traced calls.  Lines are written
+as soon as a call returns, so a slave that gets killed keeps what it traced.
+"""
+import functools
+import importlib.abc
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILE = os.getenv('CHECKBOX_TRACE_FILE')
+
+TRACED = {
+    'plainbox.impl.session.assistant': [
+        ('SessionAssistant', 'select_providers', 'provider loading'),
+        ('SessionAssistant', 'start_new_session', 'session creation'),
+        ('SessionAssistant', 'bootstrap', 'bootstrapping'),
+        ('SessionAssistant', 'finish_bootstrap', 'bootstrapping'),
+        ('SessionAssistant', 'run_job', 'job execution'),
+        ('SessionAssistant', 'export_to_transport', 'report export'),
+        ('SessionAssistant', 'export_to_file', 'report export'),
+        ('SessionAssistant', 'export_to_stream', 'report export'),
+    ],
+    'plainbox.impl.unit.template': [
+        ('TemplateUnit', 'instantiate_all', 'template instantiation'),
+    ],
+}
+
+_local = threading.local()
+
+
+def _record(phase, start, end, nested):
+    with open(TRACE_FILE, 'at') as f:
+        f.write(json.dumps({
+            'phase': phase, 'pid': os.getpid(), 'start': start, 'end': end,
+            'self': end - start - nested}) + '\n')
+
+
+def traced(phase, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            nested = stack.pop()
+            if stack:
+                stack[-1] += end - start
+            _record(phase, start, end, nested)
+    return wrapper
+
+
+class TracingFinder(importlib.abc.MetaPathFinder):
+    """Wrap the traced methods as soon as their module is executed."""
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in TRACED:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        exec_module = spec.loader.exec_module
+
+        def exec_and_trace(module):
+            exec_module(module)
+            for cls_name, method, phase in TRACED[fullname]:
+                cls = getattr(module, cls_name, None)
+                if cls is not None and hasattr(cls, method):
+                    setattr(cls, method, traced(phase, getattr(cls, method)))
+        spec.loader.exec_module = exec_and_trace
+        return spec
+
+
+if TRACE_FILE:
+    sys.meta_path.insert(0, TracingFinder())
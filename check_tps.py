@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import argparse
+
+from checkbox_tool import CheckboxTool
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the manual and automated parts of every "
+                    "*-full test plan match a fresh split of it.")
+    parser.add_argument('--provider', metavar='NAME',
+                        help="only check test plans of this provider")
+    parser.add_argument('--timing', action='store_true',
+                        help="print a startup time breakdown to stderr")
+    args = parser.parse_args()
+
+    tool = CheckboxTool()
+    if args.provider:
+        tps = tool.get_provider_test_plans(args.provider)
+    else:
+        tps = tool.all_tps
+    tps = sorted(tp for tp in tps if tp.endswith('-full'))
+    drifted = 0
+    for tp in tps:
+        diff = tool.split_drift(tp)
+        if diff:
+            drifted += 1
+            print("\n".join(diff))
+    if args.timing:
+        tool.print_timings()
+    if drifted:
+        raise SystemExit("{} of {} test plans drifted".format(
+            drifted, len(tps)))
+
+
+if __name__ == '__main__':
+    main()
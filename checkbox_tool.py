@@ -1,17 +1,19 @@
+import contextlib
+import difflib
 import os
 import re
 import shutil
 import sys
-from collections import namedtuple
-from plainbox.abc import IJobQualifier
-from plainbox.impl.session.assistant import SessionAssistant
-from plainbox.impl.unit.unit_with_id import UnitWithId
-from plainbox.impl.unit.job import JobDefinition
-from plainbox.impl.unit.template import TemplateUnit
-from plainbox.impl.unit.testplan import TestPlanUnit
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property
 
+from unit_catalog import UnitCatalog, default_cache_dir
 
-UnitProxy = namedtuple('UnitProxy', ['id', 'kind', 'extras', 'annotations'])
+
+UnitProxy = namedtuple('UnitProxy', [
+    'id', 'kind', 'extras', 'annotations', 'plugin', 'template', 'depth'])
 
 def template_to_re(uid):
     uid = uid.replace('{__index__}', r'\d+')
@@ -19,6 +21,280 @@ def template_to_re(uid):
     nongreedy = re.sub(r'\{.+?\}', '.+?', uid)
     return nongreedy, greedy
 
+def literal_prefix(pattern):
+    """
+    Return the part of `pattern` that every string it matches starts with.
+
+    Dots are left in place and stand for "any character".
+    """
+    if '|' in pattern:
+        return ''
+    for i, c in enumerate(pattern):
+        if c in '\\+()[]^$':
+            return pattern[:i]
+        if c in '*?{':
+            # the preceding character may be repeated zero times
+            return pattern[:max(i - 1, 0)]
+    return pattern
+
+class PrefixTrie:
+    def __init__(self):
+        self._root = (dict(), [])
+
+    def insert(self, key, value):
+        node = self._root
+        for c in key:
+            node = node[0].setdefault(c, (dict(), []))
+        node[1].append(value)
+
+    def prefixes_of(self, text):
+        """Values stored under keys (dots as wildcards) that prefix `text`."""
+        found = []
+        nodes = [self._root]
+        for c in text:
+            next_nodes = []
+            for children, values in nodes:
+                found += values
+                if c in children:
+                    next_nodes.append(children[c])
+                if c != '.' and '.' in children:
+                    next_nodes.append(children['.'])
+            if not next_nodes:
+                return found
+            nodes = next_nodes
+        for _, values in nodes:
+            found += values
+        return found
+
+    def extensions_of(self, prefix):
+        """Values stored under keys that start with `prefix` (dots as wildcards)."""
+        nodes = [self._root]
+        for c in prefix:
+            next_nodes = []
+            for children, _ in nodes:
+                if c == '.':
+                    next_nodes += children.values()
+                elif c in children:
+                    next_nodes.append(children[c])
+            nodes = next_nodes
+        found = []
+        while nodes:
+            children, values = nodes.pop()
+            found += values
+            nodes += children.values()
+        return found
+
+TemplateEntry = namedtuple(
+    'TemplateEntry', ['order', 'unit', 'nongreedy', 'greedy', 'specificity'])
+
+def template_specificity(uid):
+    """
+    Return how specific a template id is, as a sortable tuple.
+
+    That is the number of literal characters in the id, then the length of
+    the part before the first placeholder.
+    """
+    literal = re.sub(r'\{[^}]*\}', '', uid)
+    return len(literal), len(uid.split('{', 1)[0])
+
+class TemplateIndex:
+    """
+    Template units indexed by the literal prefix of their ids.
+
+    Lookups only try the patterns that can possibly match and return the same
+    candidates, in the same order, as trying every template in turn would.
+    When several templates match, the most specific one wins, and the
+    earliest one of those that are equally specific.  Such ties are recorded
+    in `ambiguous`.
+    """
+    def __init__(self, template_units):
+        self._by_prefix = PrefixTrie()
+        self._by_id = PrefixTrie()
+        self._best = dict()
+        self.ambiguous = OrderedDict()
+        for order, tunit in enumerate(template_units):
+            nongreedy, greedy = template_to_re(tunit.id)
+            try:
+                entry = TemplateEntry(
+                    order, tunit, re.compile(nongreedy), re.compile(greedy),
+                    template_specificity(tunit.id))
+            except re.error:
+                continue
+            self._by_prefix.insert(literal_prefix(tunit.id), entry)
+            self._by_id.insert(tunit.id, entry)
+
+    def match(self, full_id):
+        return [e.unit for e in self._match_entries(full_id)]
+
+    def _match_entries(self, full_id):
+        entries = sorted(self._by_prefix.prefixes_of(full_id),
+                         key=lambda e: e.order)
+        candidates = [e for e in entries if e.nongreedy.match(full_id)]
+        if not candidates:
+            candidates = [e for e in entries if e.greedy.match(full_id)]
+        if not candidates:
+            # ordinary matching: from include regex to template_ids
+            entries = sorted(self._by_id.extensions_of(literal_prefix(full_id)),
+                             key=lambda e: e.order)
+            candidates = [e for e in entries if re.match(full_id, e.unit.id)]
+        return candidates
+
+    def best_match(self, full_id):
+        if full_id not in self._best:
+            best = None
+            candidates = self._match_entries(full_id)
+            if candidates:
+                # sorting is stable, so equally specific ones keep their order
+                candidates.sort(key=lambda e: e.specificity, reverse=True)
+                best = candidates[0].unit
+                tied = [e.unit.id for e in candidates
+                        if e.specificity == candidates[0].specificity]
+                if len(tied) > 1:
+                    self.ambiguous[full_id] = tied
+            self._best[full_id] = best
+        return self._best[full_id]
+
+AUTOMATIC_PLUGINS = ['shell', 'resource', 'attachment']
+
+def qualified_id(line, qualifier_unit):
+    full_id = line
+    extras = ''
+    if "::" not in full_id:
+        full_id = qualifier_unit.qualify_id(full_id)
+    if '::after-suspend' in full_id:
+        full_id = full_id.replace('::after-suspend-', '::')
+        extras = '  <= {} REMOVED "after-suspend-" PREFIX'.format(full_id)
+    return full_id, extras
+
+Resolution = namedtuple(
+    'Resolution', ['kind', 'plugin', 'reason', 'template', 'manual_dep'])
+
+DependencyNode = namedtuple('DependencyNode', ['plugin', 'deps', 'template'])
+
+class DependencyGraph:
+    """
+    Classification of fully qualified ids, following their dependencies.
+
+    Every id is resolved once and the result is cached.  Ids are classified
+    one strongly connected component at a time, dependencies first, so a job
+    becomes manual when anything it (transitively) depends on is manual.
+    Dependency cycles are reported on stderr and recorded in `cycles`.
+    """
+    def __init__(self, units, template_index):
+        self._units = units
+        self._template_index = template_index
+        self._cache = dict()
+        self._nodes = dict()
+        self.cycles = []
+
+    def resolve(self, full_id):
+        if full_id not in self._cache:
+            self._resolve_from(full_id)
+        return self._cache[full_id]
+
+    def _node(self, full_id):
+        if full_id not in self._nodes:
+            template = None
+            if full_id in self._units:
+                unit = self._units[full_id]
+                plugin = unit.plugin
+                depends = unit.depends
+            else:
+                unit = template = self._template_index.best_match(full_id)
+                if not template:
+                    self._nodes[full_id] = DependencyNode(None, [], None)
+                    return self._nodes[full_id]
+                plugin = template.plugin
+                depends = template.depends
+            deps = [(dep_id, qualified_id(dep_id, unit)[0])
+                    for dep_id in (depends or '').split()]
+            self._nodes[full_id] = DependencyNode(plugin, deps, template)
+        return self._nodes[full_id]
+
+    def _resolve_from(self, root):
+        # iterative Tarjan, so deep dependency chains don't hit the
+        # recursion limit
+        index = dict()
+        lowlink = dict()
+        stack = []
+        on_stack = set()
+
+        def push(full_id):
+            index[full_id] = lowlink[full_id] = len(index)
+            stack.append(full_id)
+            on_stack.add(full_id)
+            deps = [dep for _, dep in self._node(full_id).deps]
+            work.append((full_id, iter(deps)))
+
+        work = []
+        push(root)
+        while work:
+            full_id, deps = work[-1]
+            for dep in deps:
+                if dep in self._cache:
+                    continue
+                if dep not in index:
+                    push(dep)
+                    break
+                if dep in on_stack:
+                    lowlink[full_id] = min(lowlink[full_id], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[full_id])
+                if lowlink[full_id] == index[full_id]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == full_id:
+                            break
+                    self._classify(component)
+
+    def _classify(self, component):
+        members = set(component)
+        nodes = {m: self._node(m) for m in component}
+        if len(component) > 1 or any(
+                dep in members for _, dep in nodes[component[0]].deps):
+            cycle = list(reversed(component))
+            self.cycles.append(cycle)
+            print('Dependency cycle: {}'.format(
+                ' -> '.join(cycle + cycle[:1])), file=sys.stderr)
+
+        def is_manual(node):
+            return (node.plugin or node.template) and (
+                node.plugin not in AUTOMATIC_PLUGINS)
+
+        component_manual = any(
+            is_manual(node) or any(
+                dep not in members and self._cache[dep].kind == 'manual'
+                for _, dep in node.deps)
+            for node in nodes.values())
+        for member, node in nodes.items():
+            if not (node.plugin or node.template):
+                self._cache[member] = Resolution('unknown', None, '', None, None)
+                continue
+            manual_dep = None
+            for dep_id, dep in node.deps:
+                if dep in members:
+                    dep_manual = component_manual
+                else:
+                    dep_manual = self._cache[dep].kind == 'manual'
+                if dep_manual:
+                    manual_dep = dep_id
+                    break
+            reason = ''
+            if is_manual(node) or manual_dep:
+                kind = 'manual'
+                if not is_manual(node):
+                    reason = 'manual b/c of dep on {}'.format(manual_dep)
+            else:
+                kind = 'automatic'
+            self._cache[member] = Resolution(
+                kind, node.plugin, reason, node.template, manual_dep)
+
 def unqualify_id(tp_unit, uid):
     namespace = tp_unit.qualify_id('')
     if uid.startswith(namespace):
@@ -50,173 +326,287 @@ def generate_tp_unit(tpu):
         else:
             tp_record += ' ' + val + '\n'
 
-    for symbol in tpu.fields.get_all_symbols():
-        field = symbol.name
-        if field not in write_order and '_' + field not in write_order:
-            pass
-            # print('extra field: {}'.format(field))
+    extra_fields = getattr(tpu, 'extra_fields', None)
+    if extra_fields:
+        print('{}: fields not written: {}'.format(
+            tpu.id, ', '.join(extra_fields)), file=sys.stderr)
     return tp_record
 
-class CheckboxTool:
-    def __init__(self):
-        self.sa = SessionAssistant('CheckboxTool')
-
-        self.sa.select_providers('*')
-        self.sa.start_new_session('print_sequence')
-        self.all_tps = self.sa.get_test_plans()
-
-        self.units = dict()
-        self.template_units = dict()
-        for unit in self.sa._context._unit_list:
-            u_type = type(unit)
-            if u_type == TemplateUnit:
-                unit.re_matcher, unit.re_greedy = template_to_re(unit.id)
-                self.template_units[unit.id] = unit
-            if not (issubclass(u_type, JobDefinition)):
-                continue
-            self.units[unit.id] = unit
+def edit_field_values(record_lines, field, edit):
+    """
+    Pass every value line of `field` in a .pxu record through `edit`.
 
-    def get_unit_info(self, line, qualifier_unit):
-        kind = 'unknown'
-        extras = ''
-        full_id = line
-        ret_plugin = None
-        if "::" not in full_id:
-            qid = qualifier_unit.qualify_id(full_id)
-            full_id = qid
-        if '::after-suspend' in full_id:
-            full_id = full_id.replace('::after-suspend-', '::')
-            extras = '  <= {} REMOVED "after-suspend-" PREFIX'.format(full_id)
-        if full_id in self.units.keys():
-            plugin = self.units[full_id].plugin
-            ret_plugin = plugin
-            if plugin in ['shell', 'resource', 'attachment']:
-                kind = 'automatic'
+    `edit` gets the value without indentation and line ending and returns
+    its replacement.  Everything else in the record, other fields and
+    comments included, is kept as it is.
+    """
+    field_re = re.compile(r'{}\s*:'.format(re.escape(field)))
+    in_field = False
+    new_lines = []
+    for line in record_lines:
+        content = line.rstrip('\r\n')
+        ending = line[len(content):]
+        if field_re.match(line):
+            in_field = True
+            name, value = content.split(':', 1)
+            if value.strip():
+                spacing = value[:len(value) - len(value.lstrip())]
+                line = name + ':' + spacing + edit(value.strip()) + ending
+        elif in_field and line[:1] in (' ', '\t'):
+            value = content.strip()
+            # a lone dot stands for an empty line of a multi-line value
+            if value and value != '.':
+                indent = content[:len(content) - len(content.lstrip())]
+                line = indent + edit(value) + ending
+        elif not line.startswith('#'):
+            # comments do not end a field, anything else does
+            in_field = False
+        new_lines.append(line)
+    return new_lines
+
+def split_part(tp_unit, part_id, units, label):
+    """Return a copy of `tp_unit` that only includes `units`."""
+    include_entries = [unqualify_id(tp_unit, unit.id) + unit.annotations
+                       for unit in units]
+    description = tp_unit.description
+    if description:
+        description += ' ({})'.format(label)
+    return tp_unit.copy(
+        id=unqualify_id(tp_unit, part_id), include="\n".join(include_entries),
+        name=tp_unit.name + ' ({})'.format(label), description=description)
+
+def _writable(path):
+    """Tell whether `path` can be written, creating directories as needed."""
+    if os.path.exists(path):
+        return os.access(path, os.W_OK)
+    parent = os.path.dirname(os.path.abspath(path))
+    return parent != path and _writable(parent)
+
+PxuEdit = namedtuple('PxuEdit', ['filename', 'line_start', 'line_end', 'text'])
+
+def apply_edits(edits, output_dir=None):
+    """
+    Replace line ranges of .pxu files, one read and one write per file.
+
+    Line numbers of all the edits refer to the files as they are before any
+    of the edits is applied.  Files are changed in place, after making a
+    backup, unless `output_dir` is given.  The rewritten files are then
+    written there instead, laid out as they are relative to each other.
+
+    The same edit given twice is applied once.  Different edits of
+    overlapping line ranges raise ValueError, and files that cannot be
+    written raise PermissionError, before any file is written.
+    """
+    by_file = OrderedDict()
+    for edit in edits:
+        by_range = by_file.setdefault(edit.filename, OrderedDict())
+        previous = by_range.setdefault((edit.line_start, edit.line_end), edit)
+        if previous.text != edit.text:
+            raise ValueError("Conflicting edits of {}:{}-{}".format(
+                edit.filename, edit.line_start, edit.line_end))
+    for filename, by_range in by_file.items():
+        ranges = sorted(by_range)
+        for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+            if next_start <= end:
+                raise ValueError(
+                    "Overlapping edits of {}: lines {}-{} and {}-{}".format(
+                        filename, start, end, next_start, next_end))
+        by_file[filename] = list(by_range.values())
+    if by_file and output_dir:
+        common_dir = os.path.commonpath(
+            [os.path.dirname(filename) for filename in by_file])
+    targets = OrderedDict()
+    for filename in by_file:
+        if output_dir:
+            targets[filename] = os.path.join(
+                output_dir, os.path.relpath(filename, common_dir))
+        else:
+            targets[filename] = filename
+    # a provider installed system-wide must not end up half rewritten
+    unwritable = [target for target in targets.values()
+                  if not _writable(target)]
+    if not output_dir:
+        unwritable += [filename + '.bkp' for filename in by_file
+                       if not _writable(filename + '.bkp')]
+    if unwritable:
+        raise PermissionError("Cannot write {}, no file was changed".format(
+            ', '.join(unwritable)))
+    for filename, file_edits in by_file.items():
+        with open(filename, 'rt') as f:
+            pxu = f.readlines()
+        target = targets[filename]
+        if output_dir:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        else:
+            backup_path = filename + '.bkp'
+            if os.path.exists(backup_path):
+                print("Backup file already present. Not overwriting: {}".format(
+                    backup_path))
             else:
-                kind = 'manual'
-            if self.units[full_id].depends:
-                for dep_id in self.units[full_id].depends.split():
-                    dep_kind, _ = self.get_kind_for_unit(dep_id, self.units[full_id])
-                    if dep_kind == 'manual':
-                        extras += 'deps on manual'
-        if kind == 'unknown':
-            candidates = []
-            for tid, tunit in self.template_units.items():
-                matches = re.match(tunit.re_matcher, full_id)
-                if matches:
-                    candidates.append(tunit)
-            if not candidates:
-                for tid, tunit in self.template_units.items():
-                    matches = re.match(tunit.re_greedy, full_id)
-                    if matches:
-                        candidates.append(tunit)
-            if not candidates:
-                # ordinary matching: from include regex to template_ids
-                for tid, tunit in self.template_units.items():
-                    matches = re.match(full_id, tid)
-                    if matches:
-                        candidates.append(tunit)
-
-            tunit = None
-            if len(candidates) == 1:
-                tunit = candidates[0]
-            elif len(candidates) > 1:
-                from difflib import SequenceMatcher
-                tid = sorted([c.id for c in candidates], key=lambda a: SequenceMatcher(
-                    None, a, line).ratio(), reverse=True)[0]
-                tunit = self.template_units[tid]
-
-            if tunit:
-                ret_plugin = tunit.get_record_value('plugin')
-                if tunit.get_record_value('plugin') in ['shell', 'resource', 'attachment']:
-                    kind = 'automatic'
-                else:
-                    kind = 'manual'
-                if tunit.get_record_value('depends'):
-                    for dep_id in tunit.get_record_value('depends').split():
-                        dep_kind, _ = self.get_kind_for_unit(dep_id, tunit)
-                        if dep_kind == 'manual':
-                            extras += 'deps on man'
-                            kind = 'manual'
-        if not ret_plugin:
-            ret_plugin = 'UNKNOWN'
-        return ret_plugin, extras
+                shutil.copyfile(filename, backup_path)
+                print("Backup made: {}".format(backup_path))
+        # going bottom-up keeps the line numbers of the remaining edits valid
+        for edit in sorted(file_edits, key=lambda e: e.line_start,
+                           reverse=True):
+            pxu[edit.line_start - 1:edit.line_end] = [edit.text]
+        with open(target, 'wt') as f:
+            f.write("".join(pxu))
+        print("{} rewritten!".format(target))
+
+_split_worker_tool = None
 
+def _init_split_worker(cache_dir):
+    global _split_worker_tool
+    _split_worker_tool = CheckboxTool(cache_dir)
+
+def _split_worker(tpid):
+    messages = []
+    edit = _split_worker_tool.plan_split(tpid, messages.append)
+    return edit, messages
+
+class CheckboxTool:
+    """
+    Classification and rewriting of test plans.
+
+    Nothing is loaded up front: the catalog, the template index and the
+    dependency graph are built the first time they are needed.  The time
+    spent in each of those phases is collected in `timings`.
+    """
+    def __init__(self, cache_dir=None):
+        self._cache_dir = cache_dir or default_cache_dir()
+        self.timings = OrderedDict()
+        self.nested_cycles = []
+        self._entries = dict()
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + (
+                time.perf_counter() - start)
+
+    def print_timings(self, file=sys.stderr):
+        for phase, duration in self.timings.items():
+            print('{:20}{:8.3f}s'.format(phase, duration), file=file)
+        if 'catalog load' in self.timings:
+            print('{} of {} providers rebuilt'.format(
+                len(self.catalog.rebuilt), len(self.catalog.provider_files)),
+                file=file)
+
+    def print_ambiguous(self, file=sys.stderr):
+        for full_id, template_ids in self.template_index.ambiguous.items():
+            print('{} is ambiguous, it matches: {}'.format(
+                full_id, ', '.join(template_ids)), file=file)
+
+    @cached_property
+    def catalog(self):
+        with self._timed('provider discovery'):
+            catalog = UnitCatalog(self._cache_dir)
+        with self._timed('catalog load'):
+            catalog.load()
+        if catalog.import_time:
+            # plainbox is imported lazily, in the middle of the catalog load
+            self.timings['plainbox import'] = catalog.import_time
+            self.timings['catalog load'] -= catalog.import_time
+        return catalog
+
+    @cached_property
+    def test_plans(self):
+        return self.catalog.test_plans
+
+    @cached_property
+    def all_tps(self):
+        return list(self.test_plans)
+
+    @cached_property
+    def units(self):
+        return self.catalog.jobs
+
+    @cached_property
+    def template_units(self):
+        return self.catalog.templates
+
+    @cached_property
+    def template_index(self):
+        with self._timed('indexing'):
+            return TemplateIndex(self.template_units.values())
+
+    @cached_property
+    def graph(self):
+        return DependencyGraph(self.units, self.template_index)
+
+    def get_unit_info(self, line, qualifier_unit):
+        full_id, extras = qualified_id(line, qualifier_unit)
+        resolution = self.graph.resolve(full_id)
+        if resolution.manual_dep:
+            extras += 'deps on manual'
+        return resolution.plugin or 'UNKNOWN', extras
 
     def get_kind_for_unit(self, line, qualifier_unit):
-        kind = 'unknown'
-        extras = ''
-        full_id = line
-        if "::" not in full_id:
-            qid = qualifier_unit.qualify_id(full_id)
-            full_id = qid
-        if '::after-suspend' in full_id:
-            full_id = full_id.replace('::after-suspend-', '::')
-            extras = '  <= {} REMOVED "after-suspend-" PREFIX'.format(full_id)
-        if full_id in self.units.keys():
-            plugin = self.units[full_id].plugin
-            if plugin in ['shell', 'resource', 'attachment']:
-                kind = 'automatic'
+        full_id, extras = qualified_id(line, qualifier_unit)
+        resolution = self.graph.resolve(full_id)
+        if resolution.template:
+            return resolution.kind, '   <= {}'.format(resolution.template.id)
+        return resolution.kind, resolution.reason + extras
+
+    def get_test_plan(self, tp_id):
+        return self.test_plans[tp_id]
+
+    def get_nested_part(self, tp_unit):
+        nested_parts = []
+        for tp_id in (tp_unit.nested_part or '').split():
+            tp_id = tp_unit.qualify_id(tp_id)
+            if tp_id in self.test_plans:
+                nested_parts.append(self.test_plans[tp_id])
             else:
-                kind = 'manual'
-            if self.units[full_id].depends:
-                for dep_id in self.units[full_id].depends.split():
-                    dep_kind, _ = self.get_kind_for_unit(dep_id, self.units[full_id])
-                    if dep_kind == 'manual':
-                        if kind == 'automatic':
-                            extras = 'manual b/c of dep on {}'.format(
-                                    dep_id) + extras
-                        kind = 'manual'
-        if kind == 'unknown':
-            candidates = []
-            for tid, tunit in self.template_units.items():
-                matches = re.match(tunit.re_matcher, full_id)
-                if matches:
-                    candidates.append(tunit)
-            if not candidates:
-                for tid, tunit in self.template_units.items():
-                    matches = re.match(tunit.re_greedy, full_id)
-                    if matches:
-                        candidates.append(tunit)
-            if not candidates:
-                # ordinary matching: from include regex to template_ids
-                for tid, tunit in self.template_units.items():
-                    matches = re.match(full_id, tid)
-                    if matches:
-                        candidates.append(tunit)
-
-            tunit = None
-            if len(candidates) == 1:
-                tunit = candidates[0]
-            elif len(candidates) > 1:
-                from difflib import SequenceMatcher
-                tid = sorted([c.id for c in candidates], key=lambda a: SequenceMatcher(
-                    None, a, line).ratio(), reverse=True)[0]
-                tunit = self.template_units[tid]
-
-            if tunit:
-                if tunit.get_record_value('plugin') in ['shell', 'resource', 'attachment']:
-                    kind = 'automatic'
-                else:
-                    kind = 'manual'
-                if tunit.get_record_value('depends'):
-                    for dep_id in tunit.get_record_value('depends').split():
-                        dep_kind, _ = self.get_kind_for_unit(dep_id, tunit)
-                        if dep_kind == 'manual':
-                            if kind == 'automatic':
-                                extras = 'manual b/c of dep on {}'.format(dep_id) + extras
-                            kind = 'manual'
-                extras = '   <= {}'.format(tunit.id)
-        return kind, extras
-
-    def get_run_sequence(self, tp_id, include_nested = True):
-        tp_unit = self.sa.get_test_plan(tp_id)
-        result = []
+                print("unable to find nested part: {}".format(tp_id),
+                      file=sys.stderr)
+        return nested_parts
+
+    def get_run_sequence(self, tp_id, include_nested = True, depth=0,
+                         collapse_duplicates=False):
+        """
+        Generate UnitProxy objects for every include line of the test plan.
+
+        Nested parts come first; `depth` of their entries is one more than the
+        depth of the plan that nests them.  Each plan's own entries are only
+        classified once.  With `collapse_duplicates` a plan nested through
+        several paths is only expanded the first time it is reached.  Nested
+        part cycles are reported on stderr and not followed.
+        """
+        yield from self._expand(
+            tp_id, include_nested, depth, [], set(), collapse_duplicates)
+
+    def _expand(self, tp_id, include_nested, depth, path, expanded, collapse):
+        if tp_id in path:
+            cycle = path[path.index(tp_id):] + [tp_id]
+            if cycle not in self.nested_cycles:
+                self.nested_cycles.append(cycle)
+                print('Nested part cycle: {}'.format(' -> '.join(cycle)),
+                      file=sys.stderr)
+            return
+        if collapse:
+            if tp_id in expanded:
+                return
+            expanded.add(tp_id)
         if include_nested:
-            for tp in tp_unit.get_nested_part():
+            path.append(tp_id)
+            for tp in self.get_nested_part(self.get_test_plan(tp_id)):
                 # print("NESTED {}".format(tp))
-                result += self.get_run_sequence(tp.id)
-        for line in tp_unit.include.split('\n'):
+                yield from self._expand(
+                    tp.id, True, depth + 1, path, expanded, collapse)
+            path.pop()
+        for entry in self._plan_entries(tp_id):
+            yield entry._replace(depth=depth)
+
+    def _plan_entries(self, tp_id):
+        if tp_id in self._entries:
+            return self._entries[tp_id]
+        tp_unit = self.get_test_plan(tp_id)
+        entries = []
+        for line in (tp_unit.include or '').split('\n'):
             if not line:
                 continue
             if line.startswith('#'):
@@ -226,126 +616,166 @@ class CheckboxTool:
             line = sections[0]
             line = line.split()[0]
             kind, extras = self.get_kind_for_unit(line, tp_unit)
+            resolution = self.graph.resolve(qualified_id(line, tp_unit)[0])
+            template = resolution.template.id if resolution.template else None
 
-            result.append(UnitProxy(line, kind, extras, annotations))
-
-        return result
+            entries.append(UnitProxy(line, kind, extras, annotations,
+                                     resolution.plugin, template, 0))
+        self._entries[tp_id] = entries
+        return entries
 
     def split_tp(self, tpid):
-        tp_unit = self.sa.get_test_plan(tpid)
+        edit = self.plan_split(tpid)
+        if edit:
+            apply_edits([edit])
+
+    def split_tps(self, tp_ids, jobs=None):
+        """
+        Split many test plans at once.
+
+        Plans are classified in a pool of `jobs` worker processes and every
+        affected .pxu file is then rewritten once, with all of its edits.
+        """
+        tp_ids = list(OrderedDict.fromkeys(tp_ids))
+        if jobs == 1 or len(tp_ids) == 1:
+            results = []
+            for tpid in tp_ids:
+                messages = []
+                results.append((self.plan_split(tpid, messages.append),
+                                messages))
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=jobs, initializer=_init_split_worker,
+                    initargs=(self._cache_dir,)) as pool:
+                results = list(pool.map(_split_worker, tp_ids))
+        edits = []
+        for edit, messages in results:
+            for message in messages:
+                print(message)
+            if edit:
+                edits.append(edit)
+        apply_edits(edits)
+
+    def split_drift(self, tpid):
+        """
+        Compare the existing manual and automated parts of `tpid` with what
+        splitting it now would give.
+
+        Returns a unified diff as a list of lines; it is empty when the parts
+        are up to date or when `tpid` has not been split.
+        """
+        manuals, autos = self._split_units(tpid)
+        diff = []
+        for part_tp, units in [(tpid[:-4] + 'manual', manuals),
+                               (tpid[:-4] + 'automated', autos)]:
+            if part_tp in self.test_plans:
+                diff += self._part_diff(tpid, part_tp, units)
+        return diff
+
+    def _split_units(self, tpid):
         manuals = []
         autos = []
-        unknowns = []
         for unit in self.get_run_sequence(tpid, True):
             if unit.kind == 'manual':
                 manuals.append(unit)
             if unit.kind == 'automatic':
                 autos.append(unit)
-            if unit.kind == 'unknown':
-                unknowns.append(unit)
+        return manuals, autos
+
+    def _part_diff(self, tpid, part_tp, units):
+        part_ids = [unit.id for unit in self.get_run_sequence(part_tp)]
+        new_ids = [unit.id for unit in units]
+        return list(difflib.unified_diff(
+            part_ids, new_ids, part_tp, '{} (split)'.format(tpid), n=1,
+            lineterm=''))
+
+    def plan_split(self, tpid, log=print):
+        """
+        Compute the edit that splits `tpid` into manual and automated plans.
+
+        Returns None when there is nothing to write.
+        """
+        tp_unit = self.get_test_plan(tpid)
+        manuals, autos = self._split_units(tpid)
 
         manual_tp = tpid[:-4] + 'manual'
         new_man_pxu = ""
         new_auto_pxu = ""
         if manual_tp not in self.all_tps:
-            print("missing {}".format(manual_tp))
-            new_man_tp = TestPlanUnit(tp_unit._raw_data)
-            # remove the namespace prefix
-            include_entries = []
-            for unit in manuals:
-                namespace = tp_unit.qualify_id('')
-                if unit.id.startswith(namespace):
-                    unit.id = unit.id.replace(namespace, '')
-                include_entries.append(unit.id + unit.annotations)
-            new_man_tp.id = unqualify_id(tp_unit, manual_tp)
-            new_man_tp.include = "\n".join(include_entries)
-            new_man_tp.name += ' (Manual)'
-            new_man_tp.description += ' (Manual)'
-            new_man_pxu = generate_tp_unit(new_man_tp)
+            log("missing {}".format(manual_tp))
+            new_man_pxu = generate_tp_unit(
+                split_part(tp_unit, manual_tp, manuals, 'Manual'))
         else:
-            print("{} already there".format(manual_tp))
-            man_seq = self.get_run_sequence(manual_tp)
-            man_seq_ids = [unit.id for unit in man_seq]
-            new_seq = [unit.id for unit in manuals]
-            if man_seq_ids != new_seq:
-                print("BUT HAS WRONG INCLUDE")
-                print("FULL:\n{}\n\n VS \n\nMANUAL:\n{}".format(
-                    "\n".join(new_seq), "\n".join(man_seq_ids)))
+            log("{} already there".format(manual_tp))
+            diff = self._part_diff(tpid, manual_tp, manuals)
+            if diff:
+                log("BUT HAS WRONG INCLUDE")
+                log("\n".join(diff))
         auto_tp = tpid[:-4] + 'automated'
         if auto_tp not in self.all_tps:
-            print("missing {}".format(auto_tp))
-            new_auto_tp = TestPlanUnit(tp_unit._raw_data)
-            # remove the namespace prefix
-            include_entries = []
-            for unit in autos:
-                namespace = tp_unit.qualify_id('')
-                if unit.id.startswith(namespace):
-                    unit.id = unit.id.replace(namespace, '')
-                include_entries.append(unit.id + unit.annotations)
-            new_auto_tp.id = unqualify_id(tp_unit, auto_tp)
-            new_auto_tp.include = "\n".join(include_entries)
-            new_auto_tp.name += ' (Automated)'
-            new_auto_tp.description += ' (Automated)'
-            new_auto_pxu = generate_tp_unit(new_auto_tp)
+            log("missing {}".format(auto_tp))
+            new_auto_pxu = generate_tp_unit(
+                split_part(tp_unit, auto_tp, autos, 'Automated'))
         else:
-            print("{} already there".format(auto_tp))
-            auto_seq = self.get_run_sequence(auto_tp)
-            auto_seq_ids = [unit.id for unit in auto_seq]
-            new_seq = [unit.id for unit in autos]
-
-
-            if auto_seq_ids != new_seq:
-                print("BUT HAS DIFFERENT INCLUDE")
-                print("FULL:\n{}\n\n VS \n\AUTOMATED:\n{}".format(
-                    "\n".join(new_seq), "\n".join(auto_seq_ids)))
+            log("{} already there".format(auto_tp))
+            diff = self._part_diff(tpid, auto_tp, autos)
+            if diff:
+                log("BUT HAS DIFFERENT INCLUDE")
+                log("\n".join(diff))
         if not new_man_pxu and not new_auto_pxu:
-            return
-        tp_unit.include = ""
-        tp_unit.id = unqualify_id(tp_unit, tp_unit.id)
-        tp_unit.nested_part = "\n".join([manual_tp, auto_tp])
-        new_full_pxu = generate_tp_unit(tp_unit)
-        with open(tp_unit.origin.source.filename, 'rt') as f:
-            pxu = f.readlines()
-        backup_path = tp_unit.origin.source.filename + '.bkp'
-        if os.path.exists(backup_path):
-            print("Backup file already present. Not overwriting: {}".format(
-                backup_path))
-        else:
-            shutil.copyfile(tp_unit.origin.source.filename, backup_path)
-            print("Backup made: {}".format(backup_path))
-
-        new_pxu = pxu[:tp_unit.origin.line_start-1]
-        new_pxu.append(new_full_pxu)
-        new_pxu.append("\n")
+            return None
+        new_pxu = generate_tp_unit(tp_unit.copy(
+            include="", id=unqualify_id(tp_unit, tp_unit.id),
+            nested_part="\n".join([manual_tp, auto_tp])))
+        new_pxu += "\n"
         if new_man_pxu:
-            new_pxu.append(new_man_pxu)
-            new_pxu.append("\n")
+            new_pxu += new_man_pxu + "\n"
         if new_auto_pxu:
-            new_pxu.append(new_auto_pxu)
-            new_pxu.append("\n")
-        new_pxu += pxu[tp_unit.origin.line_end:]
-        with open(tp_unit.origin.source.filename, 'wt') as f:
-            f.write("".join(new_pxu))
-        print("{} rewritten!".format(tp_unit.origin.source.filename))
+            new_pxu += new_auto_pxu + "\n"
+        return PxuEdit(tp_unit.origin.filename, tp_unit.origin.line_start,
+                       tp_unit.origin.line_end, new_pxu)
 
     def annotated_tp(self, tp_id):
-        tp_unit = self.sa.get_test_plan(tp_id)
+        return generate_tp_unit(self._annotated_unit(tp_id))
+
+    def annotate_tps(self, tp_ids, output_dir=None):
+        """
+        Annotate many test plans and write them back to their .pxu files.
+
+        All the plans share one resolution cache.  Only the include lines
+        of the records change, the rest of the .pxu files is kept as it is.
+        See `apply_edits` for where the results are written.
+        """
+        pxu_files = dict()
+        edits = []
+        for tp_id in tp_ids:
+            tp_unit = self.get_test_plan(tp_id)
+            origin = tp_unit.origin
+            if origin.filename not in pxu_files:
+                with open(origin.filename, 'rt') as f:
+                    pxu_files[origin.filename] = f.readlines()
+            record = pxu_files[origin.filename][
+                origin.line_start - 1:origin.line_end]
+            new_record = edit_field_values(
+                record, 'include',
+                lambda line: self._annotated_line(line, tp_unit))
+            edits.append(PxuEdit(origin.filename, origin.line_start,
+                                 origin.line_end, ''.join(new_record)))
+        apply_edits(edits, output_dir)
+
+    def get_provider_test_plans(self, provider):
+        return self.catalog.provider_test_plans.get(provider, [])
+
+    def _annotated_unit(self, tp_id):
+        tp_unit = self.get_test_plan(tp_id)
         new_include = ''
-        for line in tp_unit.include.split('\n'):
-            if not line:
-                new_include += line + '\n'
-                continue
-            if line.startswith('#'):
-                new_include += line + '\n'
-                continue
-            if '#!-' in line:
-                new_include += line + '\n'
-                continue
-            sections = line.split()
-            annotations = line[len(sections[0]):]
-            pattern = sections[0]
-            pattern = pattern.split()[0]
-            plugin, extras = self.get_unit_info(pattern, tp_unit)
-            new_include += '{}    #!- {} - {}\n'.format(line, plugin, extras)
-        tp_unit.include = new_include
-        return generate_tp_unit(tp_unit)
+        for line in (tp_unit.include or '').split('\n'):
+            new_include += self._annotated_line(line, tp_unit) + '\n'
+        return tp_unit.copy(include=new_include)
+
+    def _annotated_line(self, line, tp_unit):
+        if not line or line.startswith('#') or '#!-' in line:
+            return line
+        pattern = line.split()[0]
+        plugin, extras = self.get_unit_info(pattern, tp_unit)
+        return '{}    #!- {} - {}'.format(line, plugin, extras)
@@ -1,18 +1,51 @@
 #!/usr/bin/env python3
+import argparse
+import csv
+import json
 import sys
 
 from checkbox_tool import CheckboxTool
 
+FIELDS = ['id', 'kind', 'plugin', 'template', 'annotations', 'depth']
+
 def main():
-    if len(sys.argv) != 2:
-        raise SystemExit("Missing argument: test plan!")
-    tp = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        description="Print the jobs a test plan runs, and their kind.")
+    parser.add_argument('test_plan')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv'],
+                        default='text', help="output format (default: text)")
+    parser.add_argument('--collapse-duplicates', action='store_true',
+                        help="expand plans nested more than once only once")
+    parser.add_argument('--report-ambiguous', action='store_true',
+                        help="list includes that match several equally "
+                             "specific templates on stderr")
+    parser.add_argument('--timing', action='store_true',
+                        help="print a startup time breakdown to stderr")
+    args = parser.parse_args()
+    tp = args.test_plan
 
     tool = CheckboxTool()
     if tp not in tool.all_tps:
         raise SystemExit('"{}" test plan not found!'.format(tp))
-    for uid, kind, extras, annotations in tool.get_run_sequence(tp):
-        print('{0:10}{1}{2: >130}'.format(kind, uid, extras).strip())
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(FIELDS)
+    for unit in tool.get_run_sequence(
+            tp, collapse_duplicates=args.collapse_duplicates):
+        if args.format == 'text':
+            print('{0:10}{1}{2: >130}'.format(
+                unit.kind, unit.id, unit.extras).strip())
+            continue
+        record = unit._replace(annotations=unit.annotations.strip())
+        if args.format == 'jsonl':
+            print(json.dumps({field: getattr(record, field)
+                              for field in FIELDS}))
+        else:
+            writer.writerow([getattr(record, field) for field in FIELDS])
+    if args.report_ambiguous:
+        tool.print_ambiguous()
+    if args.timing:
+        tool.print_timings()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+# Copyright 2020 Canonical Ltd.
+# Written by:
+#   Maciej Kisielewski <maciej.kisielewski@canonical.com>
+#
+# Checkbox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# Checkbox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Checkbox.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Loopback proxy that sees what master and slave say to each other.
+
+benchmark.py points the master at the proxy instead of the slave.  The proxy
+forwards everything and logs when and how many bytes went which way, without
+understanding the protocol.  The log is then cut into messages: a message is
+everything one side sends before the other one answers.  A request is a
+message from the master and the call it makes lasts until the slave starts
+answering.
+"""
+
+import itertools
+import socket
+import statistics
+import threading
+import time
+
+TO_SLAVE = 'sent'
+TO_MASTER = 'received'
+
+
+class LoopbackProxy:
+    """
+    Forward connections from a local port to `target_port`.
+
+    The proxy listens on an ephemeral port, available as `port` once the
+    context is entered.  Every chunk forwarded is logged in `events` as
+    (connection number, direction, time, bytes).
+    """
+    def __init__(self, target_port, host='localhost'):
+        self.target = (host, target_port)
+        self.events = []
+        self.port = None
+        self._listener = None
+        self._threads = []
+        self._sockets = []
+
+    def __enter__(self):
+        self._listener = socket.socket()
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen()
+        self.port = self._listener.getsockname()[1]
+        self._start(self._accept)
+        return self
+
+    def __exit__(self, *exc_info):
+        # shutdown() wakes up the threads blocked on these sockets
+        for sock in [self._listener] + self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._listener.close()
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _accept(self):
+        for conn_no in itertools.count():
+            try:
+                master, _ = self._listener.accept()
+                slave = socket.create_connection(self.target)
+            except OSError:
+                return
+            self._sockets += [master, slave]
+            self._start(self._pump, conn_no, TO_SLAVE, master, slave)
+            self._start(self._pump, conn_no, TO_MASTER, slave, master)
+
+    def _pump(self, conn_no, direction, source, sink):
+        # one thread per direction, so a side that blocks on sending never
+        # keeps the other direction from being drained
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                self.events.append(
+                    (conn_no, direction, time.perf_counter(), len(data)))
+                sink.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (source, sink):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            source.close()
+
+    def stats(self):
+        return traffic_stats(self.events)
+
+
+def traffic_stats(events):
+    """
+    Count bytes, messages and calls in the proxy log `events`.
+
+    Call latency is measured from the start of a request to the start of the
+    answer, so it covers transport, (de)serialization and the slave's work.
+    """
+    messages = {TO_SLAVE: 0, TO_MASTER: 0}
+    sent = {TO_SLAVE: 0, TO_MASTER: 0}
+    latencies = []
+    connections = set()
+    last = dict()
+    for conn_no, direction, when, size in sorted(
+            events, key=lambda event: event[2]):
+        connections.add(conn_no)
+        sent[direction] += size
+        previous = last.get(conn_no)
+        if previous and previous[0] == direction:
+            continue
+        messages[direction] += 1
+        if previous and direction == TO_MASTER:
+            latencies.append(when - previous[1])
+        last[conn_no] = (direction, when)
+    latencies.sort()
+    return {
+        'connections': len(connections),
+        'bytes_sent': sent[TO_SLAVE],
+        'bytes_received': sent[TO_MASTER],
+        'messages_sent': messages[TO_SLAVE],
+        'messages_received': messages[TO_MASTER],
+        'calls': len(latencies),
+        'call_time': sum(latencies),
+        'call_median': statistics.median(latencies) if latencies else 0.0,
+        # nearest rank is good enough for the many calls of a session
+        'call_p95': latencies[int(0.95 * (len(latencies) - 1))]
+        if latencies else 0.0,
+    }
@@ -1,140 +1,243 @@
-import collections
-import concurrent
-import datetime
+import argparse
 import json
-import multiprocessing
-import os
-import shutil
-import subprocess
+import math
 import statistics
-import sys
-import tempfile
 import time
 
-from concurrent.futures import ThreadPoolExecutor
+import benchmark
+from suite import SCENARIOS, BenchmarkingTask, GitRepo, TaskPool
 
-class TaskPool:
-    def __init__(self, workers = multiprocessing.cpu_count):
-        self._queue = collections.deque()
-        self._pool = ThreadPoolExecutor(max_workers=workers)
-        self._task_map = dict()
-    def add_task(self, task):
-        self._queue.append(task)
-        self._task_map[task.commit] = self._pool.submit(task.run)
-    def run_and_wait(self):
-        self._pool.shutdown()
-        for commit, task in self._task_map.items():
-            if task.exception():
-                print("Task failed for commit {}. {}".format(commit, task.exception()))
-        return [r.result() for r in self._task_map.values()]
+def parse_pool_sizes(text):
+    sizes = set()
+    for part in text.split(','):
+        low, sep, high = part.partition('-')
+        sizes.update(range(int(low), int(high) + 1) if sep else [int(low)])
+    # everything is relative to a single worker, so that one is always measured
+    return sorted(sizes | {1})
 
-class BenchmarkingTask:
-    def __init__(self, path, commit):
-        self._path = path
-        self._commit = commit
-    @property
-    def commit(self):
-        return self._commit
-    def run(self):
-        with tempfile.TemporaryDirectory(prefix='benchmarking-') as tmp:
-            subprocess.run(['git', 'clone', '-l', self._path, tmp], check=True)
-            subprocess.run(['git', 'reset', '--hard', self._commit], check=True, cwd=tmp)
-            base_dir = os.path.split(os.path.abspath(__file__))[0]
-            shutil.copytree(
-                os.path.join(base_dir, '2019.com.canonical.certification:metabench'),
-                os.path.join(tmp, '2019.com.canonical.certification:metabench')
-            )
-            shutil.copy(os.path.join(base_dir, 'benchmark.py'), os.path.join(tmp, 'benchmark.py'))
+# one short run per task, enough to build venvs, check out trees and warm caches
+WARMUP_ARGS = ['--warmup', '0', '--repeat', '1']
 
-            # for scenario in ['small', 'templatey', 'bootstrap-only']:
-            results = []
-            for scenario in ['small', 'templatey', 'bootstrap-only']:
-                out = subprocess.check_output(
-                    ['python3', os.path.join(tmp, 'benchmark.py'), scenario])
-                elapsed = float(out.splitlines()[-1])
-                print('{} - {} : {}'.format(self._commit, scenario, elapsed))
-                results.append((self._commit, scenario, elapsed))
-            return  results
+def run_pool(repo, commit, size, tasks, scenarios, benchmark_args, pin, idle_siblings):
+    pool = TaskPool(size, pin, idle_siblings)
+    for i in range(tasks):
+        pool.add_task(BenchmarkingTask(repo, commit, scenarios=scenarios,
+                                       benchmark_args=benchmark_args))
+    start = time.perf_counter()
+    results = pool.run_and_wait()
+    return results, time.perf_counter() - start
 
-            commit_timestamp = subprocess.check_output('git show -s --format=%ct', shell=True).decode(sys.stdout.encoding)
-            commit_dt = datetime.datetime.fromtimestamp(int(commit_timestamp))
-            print(commit_dt)
-            measurement = {
-                'timestamp': commit_dt.timestamp(),
-                'cpu': get_cpu_name(),
-            }
-            subprocess.run(". venv/bin/activate; pip3 install psutil", shell=True)
-            subprocess.run(". venv/bin/activate; ../2019.com.canonical.certification:metabench/manage.py develop -d $PROVIDERPATH", shell=True)
+def prepare(repo, commit, size, scenarios, benchmark_args, pin, idle_siblings):
+    # every worker of the largest pool needs a venv slot and a worktree of its
+    # own; creating them while timing would make the first sizes look slow
+    print("*"*20, "PREPARING {} WORKERS".format(size), "*"*20)
+    run_pool(repo, commit, size, size, scenarios, benchmark_args + WARMUP_ARGS, pin, idle_siblings)
 
-            score_path = os.path.join(base_dir, 'measurements', commit)
-            if not os.path.exists(score_path):
-                print('{} info not found, benchmarking'.format(commit))
-                scores = dict()
-                # for scenario in ['small', 'templatey', 'bootstrap-only']:
-                for scenario in ['small', 'bootstrap-only']:
-                    scores[scenario] = bench(scenario)
-                    #scores[scenario] = 2.0
-                measurement['scores'] = scores
-                with open(score_path, 'wt') as f:
-                    json.dump(measurement, f, indent='  ')
-            else:
-                with open(score_path, 'rt') as f:
-                    measurement = json.load(f)
-            reqobj = {'database': 'certsandbox', 'measurements': [{
-                    'measurement': 'checkbox-perf',
-                    'time': int(measurement['timestamp'] * 10 ** 9), # sec to nsec
-                    'tags': {'cpu_name':measurement['cpu']},
-                    'fields': measurement['scores'],
-                }]}
-            r = requests.post('http://bork.monospaced.pl:8000/influx', json=reqobj)
-            print(tmp)
+def measure_pool(repo, commit, size, runs_per_worker, scenarios, benchmark_args, pin, idle_siblings):
+    # a discarded round first, so every worker starts from warm caches
+    run_pool(repo, commit, size, size, scenarios, benchmark_args + WARMUP_ARGS, pin, idle_siblings)
+    tasks = size * runs_per_worker
+    results, wall_time = run_pool(repo, commit, size, tasks, scenarios, benchmark_args,
+                                  pin, idle_siblings)
+    latencies = {scenario: [] for scenario in scenarios}
+    for task_done in results:
+        for commit, scenario, elapsed in task_done:
+            latencies[scenario].append(elapsed)
+    runs = sum(len(times) for times in latencies.values())
+    return {
+        'workers': size,
+        'tasks': tasks,
+        'failed': tasks - len(results),
+        'wall_time': wall_time,
+        'throughput': runs / wall_time,
+        'latencies': latencies,
+    }
 
-class GitRepo:
-    # TODO: turn this into a context manager for easier cleanup
-    def __init__(self, url):
-        tmpdir = tempfile.mkdtemp(prefix='benchmarking-')
-        subprocess.run(['git', 'clone', url, tmpdir])
-        self._repo_path = tmpdir
-    def get_merge_commits(self):
-        history = subprocess.check_output(
-            ['git', '-C', self._repo_path, 'log', '--pretty=%H', '--merges',])
-        commits = history.decode(sys.stdout.encoding).splitlines()
-        return commits
-    def get_local_path(self):
-        return self._roepo_path
+def latency_summary(times):
+    if not times:
+        return None
+    return {
+        'n': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'p95': benchmark.percentile(times, 95),
+        'max': max(times),
+    }
 
+def fit_usl(points):
+    # With C(N) = X(N) / X(1) the USL is N / C(N) - 1 = sigma (N - 1) + kappa N (N - 1),
+    # a least squares fit through the origin.  Amdahl's law is the same with kappa = 0.
+    x1, x2, y = [], [], []
+    for workers, speedup in points:
+        x1.append(workers - 1)
+        x2.append(workers * (workers - 1))
+        y.append(workers / speedup - 1)
+    def single(xs):
+        denominator = sum(x * x for x in xs)
+        return max(sum(x * v for x, v in zip(xs, y)) / denominator, 0.0) if denominator else 0.0
+    amdahl = single(x1)
+    s11 = sum(a * a for a in x1)
+    s22 = sum(b * b for b in x2)
+    s12 = sum(a * b for a, b in zip(x1, x2))
+    s1y = sum(a * v for a, v in zip(x1, y))
+    s2y = sum(b * v for b, v in zip(x2, y))
+    determinant = s11 * s22 - s12 * s12
+    if determinant:
+        sigma = (s1y * s22 - s2y * s12) / determinant
+        kappa = (s2y * s11 - s1y * s12) / determinant
+    else:
+        sigma, kappa = amdahl, 0.0
+    # negative coefficients have no meaning, fit the other one alone then
+    if kappa < 0:
+        sigma, kappa = amdahl, 0.0
+    elif sigma < 0:
+        sigma, kappa = 0.0, single(x2)
+    return amdahl, sigma, kappa
+
+def usl_speedup(workers, sigma, kappa):
+    return workers / (1 + sigma * (workers - 1) + kappa * workers * (workers - 1))
+
+def find_knee(pools, min_gain):
+    # the last size after which another worker adds less than `min_gain`
+    # of what the first one brings
+    base = pools[0]['throughput']
+    for pool, following in zip(pools, pools[1:]):
+        gain = (following['throughput'] - pool['throughput']) / (following['workers'] - pool['workers'])
+        if gain < min_gain * base:
+            return pool['workers']
+    return pools[-1]['workers']
+
+def latency_inflation(pools, scenarios, threshold, alpha):
+    # runs that take longer because of the others running next to them
+    # measure the neighbours as much as checkbox
+    inflation = []
+    for pool in pools:
+        entry = {'workers': pool['workers'], 'scenarios': {}, 'trustworthy': True}
+        for scenario in scenarios:
+            base = pools[0]['latencies'][scenario]
+            times = pool['latencies'][scenario]
+            if not base or not times:
+                continue
+            relative = statistics.median(times) / statistics.median(base) - 1
+            _, p = benchmark.mann_whitney(base, times)
+            inflated = relative > threshold and p < alpha
+            entry['scenarios'][scenario] = {'inflation': relative, 'p': p, 'inflated': inflated}
+            if inflated:
+                entry['trustworthy'] = False
+        inflation.append(entry)
+    trusted = 1
+    for entry in inflation:
+        if not entry['trustworthy']:
+            break
+        trusted = entry['workers']
+    return inflation, trusted
+
+def analyze(pools, scenarios, min_gain, threshold, alpha):
+    base = pools[0]['throughput']
+    amdahl, sigma, kappa = fit_usl([(pool['workers'], pool['throughput'] / base) for pool in pools])
+    inflation, trusted = latency_inflation(pools, scenarios, threshold, alpha)
+    knee = find_knee(pools, min_gain)
+    return {
+        'pools': [{
+            'workers': pool['workers'],
+            'tasks': pool['tasks'],
+            'failed': pool['failed'],
+            'wall_time': pool['wall_time'],
+            'throughput': pool['throughput'],
+            'speedup': pool['throughput'] / base,
+            'usl_speedup': usl_speedup(pool['workers'], sigma, kappa),
+            'latency': {scenario: latency_summary(pool['latencies'][scenario])
+                        for scenario in scenarios},
+        } for pool in pools],
+        'amdahl_sigma': amdahl,
+        'usl_sigma': sigma,
+        'usl_kappa': kappa,
+        'usl_peak': math.sqrt((1 - sigma) / kappa) if kappa and sigma < 1 else None,
+        'knee': knee,
+        'inflation': inflation,
+        'trusted_workers': trusted,
+        'recommended_workers': min(knee, trusted),
+    }
+
+def print_report(report, scenarios):
+    print("{:>7} {:>6} {:>9} {:>8} {:>8}".format('workers', 'failed', 'runs/s', 'speedup', 'USL'), end='')
+    for scenario in scenarios:
+        print("  {:>28}".format(scenario + ' median/p95'), end='')
+    print()
+    inflation = {entry['workers']: entry for entry in report['inflation']}
+    for pool in report['pools']:
+        print("{:>7} {:>6} {:>9.3f} {:>8.2f} {:>8.2f}".format(
+            pool['workers'], pool['failed'], pool['throughput'], pool['speedup'],
+            pool['usl_speedup']), end='')
+        for scenario in scenarios:
+            latency = pool['latency'][scenario]
+            change = inflation[pool['workers']]['scenarios'].get(scenario)
+            if latency is None:
+                print("  {:>28}".format('-'), end='')
+                continue
+            print("  {:>8.3f} / {:>7.3f} {:>+6.1%}{}".format(
+                latency['median'], latency['p95'], change['inflation'] if change else 0,
+                '!' if change and change['inflated'] else ' '), end='')
+        print()
+    print()
+    print("Amdahl: contention {:.4f}".format(report['amdahl_sigma']))
+    print("USL: contention {:.4f}, coherency {:.6f}".format(report['usl_sigma'], report['usl_kappa']), end='')
+    if report['usl_peak']:
+        print(", throughput peaks at {:.1f} workers".format(report['usl_peak']))
+    else:
+        print(", no peak")
+    print("Knee: more than {} workers hardly adds throughput".format(report['knee']))
+    print("Run latencies stay trustworthy up to {} workers (! marks inflated latencies)".format(
+        report['trusted_workers']))
+    print("Recommended: {} workers".format(report['recommended_workers']))
 
 def main():
-    master_path = sys.argv[1]
-    repo = GitRepo(master_path)
-    merge_commits = repo.get_merge_commits()
-    LARGEST_POOL = 48 # 48
-    global_res = dict()
-    for n in range(1, LARGEST_POOL + 1):
-        print("*"*20, "TASK POOL SIZE: {}".format(n), "*"*20)
-        pool = TaskPool(n)
-        for commit in merge_commits[:1]:
-            for i in range(n * 3):
-                pool.add_task(BenchmarkingTask(master_path, commit))
-        results = dict()
-        for task_done in pool.run_and_wait():
-            for commit, scenario, elapsed in task_done:
-                if scenario not in results.keys():
-                    results[scenario] = dict()
-                if scenario not in global_res.keys():
-                    global_res[scenario] = dict()
-                if commit not in results[scenario].keys():
-                    results[scenario][commit] = list()
-                results[scenario][commit].append(elapsed)
-            for scenario, commits in results.items():
-                print("="*20, scenario, "="*20)
-                for commit, times in commits.items():
-                    median = statistics.median(times)
-                    print("{} : {}".format(commit, median))
-                global_res[scenario][n] = median
-                #print(global_res)
-    js = json.dumps(global_res, indent="  ")
-    print(js)
+    parser = argparse.ArgumentParser(
+        description="Measure how benchmarking throughput and run latency scale with the pool size.")
+    parser.add_argument('repo', help="checkbox repository to benchmark")
+    parser.add_argument('--commit', help="commit to benchmark (default: the latest merge)")
+    parser.add_argument('--pool-sizes', type=parse_pool_sizes,
+                        help="pool sizes to try, like 1-8,12,16 (default: 1 up to one per CPU)")
+    parser.add_argument('--runs-per-worker', type=int, default=3,
+                        help="tasks queued per worker (default: %(default)s)")
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS)
+    parser.add_argument('--repeat', type=int,
+                        help="measured runs within every benchmark.py run")
+    parser.add_argument('--min-gain', type=float, default=0.1,
+                        help="throughput one more worker has to add, relative to a single "
+                             "worker, not to be past the knee (default: %(default)s)")
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help="relative latency increase that makes results untrustworthy "
+                             "(default: %(default)s)")
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help="significance level (default: %(default)s)")
+    parser.add_argument('--no-pin', action='store_true',
+                        help="do not pin the workers to their own CPUs")
+    parser.add_argument('--idle-siblings', action='store_true',
+                        help="pin to one hardware thread per core, leaving SMT siblings idle")
+    parser.add_argument('--output', help="write the report as JSON here")
+    args = parser.parse_args()
+    if not args.pool_sizes:
+        args.pool_sizes = list(range(1, len(benchmark.cpu_sets(None, args.idle_siblings)) + 1))
+    benchmark_args = ['--repeat', str(args.repeat)] if args.repeat else []
+    with GitRepo(args.repo) as repo:
+        commit = repo.rev_parse(args.commit) if args.commit else repo.get_merge_commits()[0]
+        prepare(repo, commit, max(args.pool_sizes), args.scenarios, benchmark_args,
+                not args.no_pin, args.idle_siblings)
+        pools = []
+        for size in args.pool_sizes:
+            print("*"*20, "TASK POOL SIZE: {}".format(size), "*"*20)
+            pools.append(measure_pool(repo, commit, size, args.runs_per_worker,
+                                      args.scenarios, benchmark_args, not args.no_pin,
+                                      args.idle_siblings))
+    if not pools[0]['throughput']:
+        raise SystemExit("Every run of the single worker failed, there is nothing to scale from")
+    report = analyze(pools, args.scenarios, args.min_gain, args.threshold, args.alpha)
+    report['commit'] = commit
+    print_report(report, args.scenarios)
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent="  ")
 
 if __name__ == '__main__':
     main()
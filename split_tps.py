@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 
 from checkbox_tool import CheckboxTool
 
 def main():
-    if len(sys.argv) < 2:
-        raise SystemExit("Missing argument: test plan(s)!")
-    tp = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        description="Split test plans into manual and automated parts.")
+    parser.add_argument('test_plans', nargs='+', metavar='test_plan')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--timing', action='store_true',
+                        help="print a startup time breakdown to stderr")
+    args = parser.parse_args()
 
     tool = CheckboxTool()
     
-    for tp in sys.argv[1:]:
+    for tp in args.test_plans:
         if tp not in tool.all_tps:
             raise SystemExit('"{}" test plan not found!'.format(tp))
-        tool.split_tp(tp)
+    try:
+        tool.split_tps(args.test_plans, args.jobs)
+    except (ValueError, PermissionError) as exc:
+        raise SystemExit(exc)
+    if args.timing:
+        tool.print_timings()
 
 
 if __name__ == '__main__':
@@ -1,113 +1,469 @@
-import collections
-import concurrent
-import datetime
-import multiprocessing
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import platform
 import shutil
+import sqlite3
+import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
-from concurrent.futures import ThreadPoolExecutor
+import benchmark
 
+BASE_DIR = os.path.split(os.path.abspath(__file__))[0]
+HARNESS_FILES = ['benchmark.py', 'rpc_proxy.py', 'synthetic.py', 'venv_cache.py']
+HARNESS_DIRS = ['benchmarking-provider', 'benchmarking-trace']
+SCENARIOS = ['small', 'templatey', 'bootstrap-only']
+# benchmark.py's default, every worker gets its own range of ports from there
+BASE_PORT = 18871
+PORTS_PER_WORKER = 100
+
+def read_elapsed(results_path, mode='local'):
+    with open(results_path, 'rt') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['mode'] == mode:
+                return record['summary']['median']
+    raise ValueError("No {} results in {}".format(mode, results_path))
+
+def host_fingerprint():
+    # only what decides the speed; the host name and the kernel release
+    # change too often and are kept with every measurement instead
+    host = json.dumps({'cpu': benchmark.cpu_name(), 'cpus': os.cpu_count(),
+                       'arch': platform.machine()}, sort_keys=True)
+    return hashlib.sha1(host.encode()).hexdigest()[:12]
+
+def harness_version():
+    # anything that changes what benchmark.py measures makes old results
+    # incomparable, so the files themselves are the version
+    version = hashlib.sha1()
+    paths = [os.path.join(BASE_DIR, name) for name in HARNESS_FILES]
+    for harness_dir in HARNESS_DIRS:
+        for root, dirs, files in os.walk(os.path.join(BASE_DIR, harness_dir)):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            paths += [os.path.join(root, name) for name in sorted(files)
+                      if not name.startswith(('synthetic', 'launcher-synthetic'))]
+    for path in paths:
+        with open(path, 'rb') as f:
+            version.update(os.path.relpath(path, BASE_DIR).encode() + b'\0')
+            version.update(f.read())
+    return version.hexdigest()[:12]
+
+# Benchmark results keyed by (commit, scenario, mode, host, harness), host and
+# harness being fingerprints, so that results from other machines or other
+# versions of the benchmarks are kept but never mixed up with current ones.
+class MeasurementStore:
+    def __init__(self, path):
+        self._path = path
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS measurements (
+                    commit_id TEXT NOT NULL,
+                    scenario TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    host TEXT NOT NULL,
+                    harness TEXT NOT NULL,
+                    commit_time INTEGER,
+                    measured_at TEXT,
+                    median REAL,
+                    record TEXT,
+                    hostname TEXT,
+                    platform TEXT,
+                    PRIMARY KEY (commit_id, scenario, mode, host, harness))""")
+            columns = [row[1] for row in db.execute("PRAGMA table_info(measurements)")]
+            for column in ['hostname', 'platform']:
+                if column not in columns:
+                    db.execute("ALTER TABLE measurements ADD COLUMN {} TEXT".format(column))
+    @contextlib.contextmanager
+    def _connect(self):
+        # a connection per use, as tasks store their results from threads
+        db = sqlite3.connect(self._path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+    def add(self, commit, commit_time, host, harness, record):
+        with self._connect() as db:
+            host_info = record.get('host', {})
+            db.execute(
+                "INSERT OR REPLACE INTO measurements (commit_id, scenario, mode, host, "
+                "harness, commit_time, measured_at, median, record, hostname, platform) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (commit, record['scenario'], record['mode'], host, harness,
+                 commit_time, record['timestamp'],
+                 record['summary']['median'], json.dumps(record),
+                 host_info.get('name'), host_info.get('platform')))
+    def has(self, commit, scenario, host, harness):
+        with self._connect() as db:
+            return db.execute(
+                "SELECT 1 FROM measurements WHERE commit_id = ? AND "
+                "scenario = ? AND host = ? AND harness = ? LIMIT 1",
+                (commit, scenario, host, harness)).fetchone() is not None
+    def get(self, commit, scenario, mode, host, harness):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT record FROM measurements WHERE commit_id = ? AND "
+                "scenario = ? AND mode = ? AND host = ? AND harness = ?",
+                (commit, scenario, mode, host, harness)).fetchone()
+        return json.loads(row[0]) if row else None
+    def missing(self, commits, scenarios, host, harness):
+        return [commit for commit in commits if not all(
+            self.has(commit, scenario, host, harness) for scenario in scenarios)]
+    def history(self, scenario, mode='local', host=None, harness=None):
+        query = ("SELECT commit_id, commit_time, median, host, harness "
+                 "FROM measurements WHERE scenario = ? AND mode = ?")
+        params = [scenario, mode]
+        for column, value in [('host', host), ('harness', harness)]:
+            if value:
+                query += " AND {} = ?".format(column)
+                params.append(value)
+        with self._connect() as db:
+            return db.execute(
+                query + " ORDER BY commit_time, commit_id", params).fetchall()
+
+# Runs tasks on `workers` slots, each slot having its own CPUs and ports.  The
+# benchmarks themselves run in processes of their own, started from a thread
+# pinned to the slot's CPUs; the threads only hand out tasks.  Tasks with lower priority
+# values go first and failed ones are queued again up to `retries` times.
 class TaskPool:
-    def __init__(self, workers = multiprocessing.cpu_count):
-        self._queue = collections.deque()
-        self._pool = ThreadPoolExecutor(max_workers=workers)
-        self._task_map = dict()
-    def add_task(self, task):
-        self._queue.append(task)
-        self._task_map[task.commit] = self._pool.submit(task.run)
+    def __init__(self, workers=None, pin=True, idle_siblings=False, retries=0):
+        if pin:
+            self._cpu_sets = benchmark.cpu_sets(workers, idle_siblings)
+        else:
+            self._cpu_sets = [None] * (workers or os.cpu_count())
+        self._retries = retries
+        self._queue = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        # a list, as there may be several tasks for one commit
+        self._tasks = []
+    def add_task(self, task, priority=0):
+        future = concurrent.futures.Future()
+        self._push(priority, 0, task, future)
+        self._tasks.append((task.commit, future))
+    def _push(self, priority, attempt, task, future):
+        with self._lock:
+            heapq.heappush(self._queue, (priority, next(self._order), attempt, task, future))
+    def _pop(self):
+        with self._lock:
+            return heapq.heappop(self._queue) if self._queue else None
+    def _work(self, slot, cpus):
+        port = BASE_PORT + slot * PORTS_PER_WORKER
+        if cpus:
+            # pid 0 is this thread, and whatever it starts inherits its
+            # affinity, so benchmark.py and checkbox-cli end up on our CPUs
+            os.sched_setaffinity(0, cpus)
+        while True:
+            item = self._pop()
+            if item is None:
+                return
+            priority, _, attempt, task, future = item
+            try:
+                result = task.run(port)
+            except Exception as exc:
+                if attempt < self._retries:
+                    print("Task failed for commit {}, retrying. {}".format(task.commit, exc))
+                    self._push(priority, attempt + 1, task, future)
+                else:
+                    future.set_exception(exc)
+            except BaseException as exc:
+                future.set_exception(exc)
+                raise
+            else:
+                future.set_result(result)
     def run_and_wait(self):
-        self._pool.shutdown()
-        for commit, task in self._task_map.items():
-            if task.exception():
+        workers = [threading.Thread(target=self._work, args=(slot, cpus))
+                   for slot, cpus in enumerate(self._cpu_sets)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # left over when a worker died of something other than an Exception
+        while self._queue:
+            self._pop()[-1].cancel()
+        results = []
+        for commit, task in self._tasks:
+            if task.cancelled():
+                print("Task for commit {} was not run.".format(commit))
+            elif task.exception():
                 print("Task failed for commit {}. {}".format(commit, task.exception()))
+            else:
+                results.append(task.result())
+        return results
 
 class BenchmarkingTask:
-    def __init__(self, path, commit):
-        self._path = path
+    def __init__(self, repo, commit, store=None, scenarios=SCENARIOS, benchmark_args=()):
+        self._repo = repo
         self._commit = commit
+        self._store = store
+        self._scenarios = scenarios
+        self._benchmark_args = list(benchmark_args)
     @property
     def commit(self):
         return self._commit
-    def run(self):
-        with tempfile.TemporaryDirectory(prefix='benchmarking-') as tmp:
-            subprocess.run(['git', 'clone', '-l', self._path, tmp], check=True)
-            subprocess.run(['git', 'reset', '--hard', self._commit], check=True, cwd=tmp)
-            base_dir = os.path.split(os.path.abspath(__file__))[0]
-            shutil.copytree(
-                os.path.join(base_dir, '2019.com.canonical.certification:metabench'),
-                os.path.join(tmp, '2019.com.canonical.certification:metabench')
-            )
-            shutil.copy(os.path.join(base_dir, 'benchmark.py'), os.path.join(tmp, 'benchmark.py'))
+    def run(self, port=None):
+        host = host_fingerprint()
+        harness = harness_version()
+        scenarios = [s for s in self._scenarios if not (
+            self._store and self._store.has(self._commit, s, host, harness))]
+        results = []
+        if not scenarios:
+            return results
+        with self._repo.checkout(self._commit) as tmp:
+            commit_time = int(subprocess.check_output(
+                ['git', 'show', '-s', '--format=%ct', self._commit], cwd=tmp))
+            benchmark_args = list(self._benchmark_args)
+            if port is not None:
+                benchmark_args += ['--base-port', str(port)]
+            for scenario in scenarios:
+                results_path = os.path.join(tmp, 'results-{}.jsonl'.format(scenario))
+                subprocess.run(['python3', 'benchmark.py', scenario, '--output', results_path] + benchmark_args,
+                               check=True, cwd=tmp)
+                elapsed = read_elapsed(results_path)
+                print('{} - {} : {}'.format(self._commit, scenario, elapsed))
+                results.append((self._commit, scenario, elapsed))
+                if self._store:
+                    with open(results_path, 'rt') as f:
+                        for line in f:
+                            self._store.add(self._commit, commit_time, host, harness, json.loads(line))
+        return results
 
-            try:
-                os.chdir(tmp)
-                for scenario in ['small', 'templatey', 'bootstrap-only']:
-                    out = subprocess.check_output(['python3', 'benchmark.py', scenario])
-                    elapsed = float(out.splitlines()[-1])
-                    print('{} - {} : {}'.format(self._commit, scenario, elapsed))
-            finally:
-                os.chdir(base_dir)
-            return
-
-            commit_timestamp = subprocess.check_output('git show -s --format=%ct', shell=True).decode(sys.stdout.encoding)
-            commit_dt = datetime.datetime.fromtimestamp(int(commit_timestamp))
-            print(commit_dt)
-            measurement = {
-                'timestamp': commit_dt.timestamp(),
-                'cpu': get_cpu_name(),
-            }
-            subprocess.run(". venv/bin/activate; pip3 install psutil", shell=True)
-            subprocess.run(". venv/bin/activate; ../2019.com.canonical.certification:metabench/manage.py develop -d $PROVIDERPATH", shell=True)
-
-            score_path = os.path.join(base_dir, 'measurements', commit)
-            if not os.path.exists(score_path):
-                print('{} info not found, benchmarking'.format(commit))
-                scores = dict()
-                for scenario in ['small', 'templatey', 'bootstrap-only']:
-                    scores[scenario] = bench(scenario)
-                    #scores[scenario] = 2.0
-                measurement['scores'] = scores
-                with open(score_path, 'wt') as f:
-                    json.dump(measurement, f, indent='  ')
-            else:
-                with open(score_path, 'rt') as f:
-                    measurement = json.load(f)
-            reqobj = {'database': 'certsandbox', 'measurements': [{
-                    'measurement': 'checkbox-perf',
-                    'time': int(measurement['timestamp'] * 10 ** 9), # sec to nsec
-                    'tags': {'cpu_name':measurement['cpu']},
-                    'fields': measurement['scores'],
-                }]}
-            r = requests.post('http://bork.monospaced.pl:8000/influx', json=reqobj)
-            print(tmp)
+def link_harness(tree):
+    # symlinks rather than copies, the harness is the same for every commit
+    for name in HARNESS_FILES + HARNESS_DIRS:
+        path = os.path.join(tree, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(os.path.join(BASE_DIR, name), path)
 
+# Clones `url` once; checkout() then hands out git worktrees of that clone,
+# reusing the ones earlier tasks are done with.  Everything is removed when
+# the context exits.
 class GitRepo:
-    # TODO: turn this into a context manager for easier cleanup
     def __init__(self, url):
-        tmpdir = tempfile.mkdtemp(prefix='benchmarking-')
-        subprocess.run(['git', 'clone', url, tmpdir])
-        self._repo_path = tmpdir
+        self._tmpdir = tempfile.mkdtemp(prefix='benchmarking-')
+        self._repo_path = os.path.join(self._tmpdir, 'repo')
+        subprocess.run(['git', 'clone', url, self._repo_path], check=True)
+        self._lock = threading.Lock()
+        self._worktrees = []
+        self._free_worktrees = []
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+    def close(self):
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+    @contextlib.contextmanager
+    def checkout(self, commit):
+        with self._lock:
+            if self._free_worktrees:
+                path = self._free_worktrees.pop()
+            else:
+                path = os.path.join(self._tmpdir, 'worktree-{}'.format(len(self._worktrees)))
+                # worktree add touches the main repository, so not in parallel
+                subprocess.run(['git', '-C', self._repo_path, 'worktree', 'add', '--detach',
+                                path, commit], check=True, stdout=subprocess.DEVNULL)
+                self._worktrees.append(path)
+        try:
+            subprocess.run(['git', '-C', path, 'checkout', '--force', '--detach', commit],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run(['git', '-C', path, 'clean', '-ffdxq'], check=True)
+            link_harness(path)
+            yield path
+        finally:
+            with self._lock:
+                self._free_worktrees.append(path)
     def get_merge_commits(self):
         history = subprocess.check_output(
             ['git', '-C', self._repo_path, 'log', '--pretty=%H', '--merges',])
         commits = history.decode(sys.stdout.encoding).splitlines()
         return commits
+    def rev_parse(self, rev):
+        return subprocess.check_output(
+            ['git', '-C', self._repo_path, 'rev-parse', '--verify', rev + '^{commit}']
+        ).decode(sys.stdout.encoding).strip()
+    def get_first_parent_commits(self, good, bad):
+        history = subprocess.check_output(
+            ['git', '-C', self._repo_path, 'rev-list', '--first-parent', '--reverse',
+             '{}..{}'.format(good, bad)])
+        return history.decode(sys.stdout.encoding).splitlines()
+    def get_parents(self, commit):
+        parents = subprocess.check_output(
+            ['git', '-C', self._repo_path, 'rev-list', '--parents', '-n', '1', commit])
+        return parents.decode(sys.stdout.encoding).split()[1:]
+    def get_branch_commits(self, merge):
+        # what the merge brought in, oldest first, ending with its second parent
+        history = subprocess.check_output(
+            ['git', '-C', self._repo_path, 'rev-list', '--reverse', '--topo-order',
+             '{0}^1..{0}^2'.format(merge)])
+        return history.decode(sys.stdout.encoding).splitlines()
     def get_local_path(self):
-        return self._roepo_path
+        return self._repo_path
+
+def sweep(args):
+    store = MeasurementStore(args.store)
+    with GitRepo(args.repo) as repo:
+        commits = repo.get_merge_commits()
+        if args.limit:
+            commits = commits[:args.limit]
+        missing = store.missing(commits, args.scenarios, host_fingerprint(), harness_version())
+        print("{} of {} merge commits need benchmarking".format(len(missing), len(commits)))
+        pool = TaskPool(args.jobs, not args.no_pin, args.idle_siblings, args.retries)
+        for commit in missing:
+            pool.add_task(BenchmarkingTask(repo, commit, store, args.scenarios))
+        pool.run_and_wait()
+
+class Bisection:
+    def __init__(self, repo, store, scenario, mode, threshold, alpha, benchmark_args):
+        self._repo = repo
+        self._store = store
+        self._scenario = scenario
+        self._mode = mode
+        self._threshold = threshold
+        self._alpha = alpha
+        self._benchmark_args = benchmark_args
+        self._host = host_fingerprint()
+        self._harness = harness_version()
+        self._verdicts = dict()
+        self._reference = None
+        self.benchmarked = 0
+    def samples(self, commit):
+        record = self._store.get(
+            commit, self._scenario, self._mode, self._host, self._harness)
+        if record is None:
+            self.benchmarked += 1
+            BenchmarkingTask(self._repo, commit, self._store, [self._scenario],
+                             self._benchmark_args).run()
+            record = self._store.get(
+                commit, self._scenario, self._mode, self._host, self._harness)
+        return [sample['duration'] for sample in record['samples']]
+    def set_good(self, commit):
+        self._reference = self.samples(commit)
+        self._verdicts[commit] = False
+        print('{} good (reference, median {:.3f})'.format(
+            commit[:12], statistics.median(self._reference)))
+    def is_bad(self, commit):
+        # slower than the good commit by more than the threshold, and not by
+        # chance; an inconclusive step counts as good
+        if commit not in self._verdicts:
+            samples = self.samples(commit)
+            median = statistics.median(samples)
+            change = median / statistics.median(self._reference) - 1
+            _, p = benchmark.mann_whitney(self._reference, samples)
+            self._verdicts[commit] = change > self._threshold and p < self._alpha
+            print('{} {} (median {:.3f}, {:+.1%}, p={:.3f})'.format(
+                commit[:12], 'bad' if self._verdicts[commit] else 'good',
+                median, change, p))
+        return self._verdicts[commit]
+    def first_bad(self, commits):
+        # commits[-1] is known to be bad and whatever precedes commits[0] good
+        good, bad = -1, len(commits) - 1
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if self.is_bad(commits[middle]):
+                bad = middle
+            else:
+                good = middle
+        return commits[bad]
+
+def bisect(args):
+    store = MeasurementStore(args.store)
+    with GitRepo(args.repo) as repo:
+        _bisect(repo, store, args)
+
+def _bisect(repo, store, args):
+    good = repo.rev_parse(args.good)
+    bad = repo.rev_parse(args.bad)
+    bisection = Bisection(repo, store, args.scenario, args.mode, args.threshold,
+                          args.alpha, ['--repeat', str(args.repeat)])
+    bisection.set_good(good)
+    if not bisection.is_bad(bad):
+        raise SystemExit("{} is not significantly slower than {}".format(args.bad, args.good))
+    merges = repo.get_first_parent_commits(good, bad)
+    culprit = bisection.first_bad(merges)
+    parents = repo.get_parents(culprit)
+    if len(parents) > 1:
+        print("Regression came with merge {}, looking into its commits".format(culprit[:12]))
+        branch = repo.get_branch_commits(culprit)
+        # the first parent is good, it is the previous first-parent commit
+        bisection.set_good(parents[0])
+        if branch and bisection.is_bad(branch[-1]):
+            culprit = bisection.first_bad(branch)
+        else:
+            print("The branch alone is fine, the merge itself is to blame")
+    print("First bad commit: {} ({} benchmarks run)".format(culprit, bisection.benchmarked))
 
+def history(args):
+    store = MeasurementStore(args.store)
+    host = None if args.any_host else host_fingerprint()
+    harness = None if args.any_harness else harness_version()
+    print('commit,commit_time,median,host,harness')
+    for row in store.history(args.scenario, args.mode, host, harness):
+        print(','.join(str(value) for value in row))
 
 def main():
-    master_path = sys.argv[1]
-    repo = GitRepo(master_path)
-    commits = repo.get_merge_commits()
-    pool = TaskPool(1)
-    for commit in commits[:10]:
-        pool.add_task(BenchmarkingTask(master_path, commit))
-    pool.run_and_wait()
+    parser = argparse.ArgumentParser(
+        description="Benchmark the merge history of a checkbox repository.")
+    parser.add_argument('--store', default=os.path.join(BASE_DIR, 'measurements.sqlite'),
+                        help="measurement database (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest='command')
+    sweep_parser = subparsers.add_parser(
+        'sweep', help="benchmark the merges that are not in the store yet")
+    sweep_parser.add_argument('repo', help="checkbox repository to benchmark")
+    sweep_parser.add_argument('--scenarios', nargs='+', default=SCENARIOS)
+    sweep_parser.add_argument('--limit', type=int,
+                              help="only look at this many latest merges")
+    sweep_parser.add_argument('-j', '--jobs', type=int, default=1,
+                              help="benchmarks to run in parallel, 0 for one per CPU (default: %(default)s)")
+    sweep_parser.add_argument('--no-pin', action='store_true',
+                              help="do not pin the workers to their own CPUs")
+    sweep_parser.add_argument('--idle-siblings', action='store_true',
+                              help="pin to one hardware thread per core, leaving SMT siblings idle")
+    sweep_parser.add_argument('--retries', type=int, default=0,
+                              help="times to retry a failed benchmark (default: %(default)s)")
+    sweep_parser.set_defaults(func=sweep)
+    history_parser = subparsers.add_parser(
+        'history', help="print a scenario's medians in commit order as CSV")
+    history_parser.add_argument('scenario')
+    history_parser.add_argument('--mode', default='local', choices=['local', 'remote'])
+    history_parser.add_argument('--any-host', action='store_true',
+                                help="include results from other hosts")
+    history_parser.add_argument('--any-harness', action='store_true',
+                                help="include results of other harness versions")
+    history_parser.set_defaults(func=history)
+    bisect_parser = subparsers.add_parser(
+        'bisect', help="find the commit that made a scenario slower")
+    bisect_parser.add_argument('repo', help="checkbox repository to benchmark")
+    bisect_parser.add_argument('good', help="a commit with the old performance")
+    bisect_parser.add_argument('bad', help="a later commit that is slower")
+    bisect_parser.add_argument('--scenario', required=True)
+    bisect_parser.add_argument('--mode', default='local', choices=['local', 'remote'])
+    bisect_parser.add_argument('--threshold', type=float, default=0.05,
+                               help="relative slowdown that counts as bad (default: %(default)s)")
+    bisect_parser.add_argument('--alpha', type=float, default=0.05,
+                               help="significance level (default: %(default)s)")
+    bisect_parser.add_argument('--repeat', type=int, default=10,
+                               help="measured runs per commit (default: %(default)s)")
+    bisect_parser.set_defaults(func=bisect)
+    # `suite.py REPO` keeps working as a sweep
+    argv = sys.argv[1:]
+    if argv and not argv[0].startswith('-') and argv[0] not in ('sweep', 'history', 'bisect'):
+        argv = ['sweep'] + argv
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error("a command is required")
+    args.func(args)
 
 
 
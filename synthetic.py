@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd.
+# Written by:
+#   Maciej Kisielewski <maciej.kisielewski@canonical.com>
+#
+# Checkbox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# Checkbox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Checkbox.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Generate synthetic load for the benchmarking provider.
+
+Every load is a test plan of generated jobs: a resource job emits `records`
+records and each of the `templates` templates is instantiated once per
+record.  Every generated job depends on `fanout` plain jobs, `manual` percent
+of the templates are manual instead of shell jobs, and the test plan reaches
+the jobs through `depth` levels of nested parts.
+
+A grid is given as PARAM=V1,V2,... specs, parameters that are not mentioned
+keep their default.  For every point of the grid a .pxu file and a launcher
+are written.
+"""
+
+import argparse
+import itertools
+import os
+from collections import namedtuple
+
+NAMESPACE = '2019.com.canonical.certification'
+
+Load = namedtuple('Load', ['templates', 'records', 'fanout', 'depth',
+                           'manual'])
+DEFAULT_LOAD = Load(templates=10, records=100, fanout=0, depth=0, manual=0)
+
+LAUNCHER = """#!/usr/bin/env checkbox-cli
+[launcher]
+launcher_version = 1
+stock_reports =
+
+[test plan]
+unit = {namespace}::{prefix}-tp
+forced = yes
+
+[test selection]
+forced = yes
+
+[ui]
+type = silent
+"""
+
+
+def load_tag(load):
+    """Short name of `load`, usable in unit ids and file names."""
+    return 't{}-r{}-f{}-d{}-m{}'.format(*load)
+
+
+def job_count(load):
+    """Number of jobs the test plan of `load` runs."""
+    return load.templates * load.records + load.fanout + 1
+
+
+def parse_grid(specs):
+    """Turn PARAM=V1,V2,... specs into a dict of value lists."""
+    grid = dict()
+    for spec in specs:
+        param, sep, values = spec.partition('=')
+        if not sep or param not in Load._fields:
+            raise ValueError("Bad grid spec {!r}, expected one of {} followed "
+                             "by =V1,V2,...".format(spec, ', '.join(
+                                 Load._fields)))
+        try:
+            grid[param] = [int(v) for v in values.split(',')]
+        except ValueError:
+            raise ValueError("Bad values in grid spec {!r}".format(spec))
+        if param == 'manual' and not all(0 <= v <= 100 for v in grid[param]):
+            raise ValueError("manual is a percentage, got {!r}".format(spec))
+    return grid
+
+
+def grid_points(grid):
+    """Every combination of the values in `grid`, as Loads."""
+    params = [(param, grid.get(param, [getattr(DEFAULT_LOAD, param)]))
+              for param in Load._fields]
+    return [Load(*values) for values in itertools.product(
+        *(values for _, values in params))]
+
+
+def generate_units(load, prefix='synthetic'):
+    """Return the pxu text of `load`, all ids starting with `prefix`."""
+    records = []
+    depends = ' '.join(
+        '{}-dep-{}'.format(prefix, i) for i in range(1, load.fanout + 1))
+    for level in range(load.depth + 1):
+        tp = ['unit: test plan',
+              'id: {}-tp{}'.format(prefix, '-{}'.format(level) if level
+                                   else ''),
+              '_name: Synthetic load {} (level {})'.format(
+                  load_tag(load), level)]
+        if level < load.depth:
+            tp += ['nested_part: {}-tp-{}'.format(prefix, level + 1),
+                   'include:']
+        else:
+            tp += ['include:',
+                   ' {}-dep-.*'.format(prefix),
+                   ' {}-job-.*'.format(prefix)]
+        if level == 0:
+            # bootstrapping is only done for the plan that is run
+            tp += ['bootstrap_include:',
+                   ' {}-resource'.format(prefix)]
+        records.append(tp)
+    records.append([
+        'id: {}-resource'.format(prefix),
+        'plugin: resource',
+        'command:',
+        ' for i in $(seq {}); do'.format(load.records),
+        '   echo n: $i',
+        '   echo',
+        ' done'])
+    for i in range(1, load.fanout + 1):
+        records.append([
+            'id: {}-dep-{}'.format(prefix, i),
+            'plugin: shell',
+            'flags: simple',
+            'command: true'])
+    manual = round(load.templates * load.manual / 100)
+    for t in range(1, load.templates + 1):
+        template = [
+            'unit: template',
+            'template-resource: {}-resource'.format(prefix),
+            'id: {}-job-{}-{{n}}'.format(prefix, t),
+            '_summary: Synthetic job {} ({{n}})'.format(t)]
+        if t <= manual:
+            template += ['plugin: manual',
+                         '_description: Synthetic manual job {}'.format(t)]
+        else:
+            template += ['plugin: shell', 'command: true']
+        if depends:
+            template.append('depends: {}'.format(depends))
+        records.append(template)
+    return '\n\n'.join('\n'.join(record) for record in records) + '\n'
+
+
+def generate_launcher(prefix='synthetic'):
+    """Return the launcher running the test plan with `prefix`."""
+    return LAUNCHER.format(namespace=NAMESPACE, prefix=prefix)
+
+
+def write_load(load, units_path, launcher_path, prefix='synthetic'):
+    """Write the units and the launcher of `load`."""
+    with open(units_path, 'wt') as f:
+        f.write(generate_units(load, prefix))
+    with open(launcher_path, 'wt') as f:
+        f.write(generate_launcher(prefix))
+    os.chmod(launcher_path, 0o755)
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'grid', nargs='*', metavar='PARAM=V1,V2,...',
+        help="values to generate loads for, PARAM being one of {}".format(
+            ', '.join(Load._fields)))
+    parser.add_argument('--units-dir', default='benchmarking-provider/units',
+                        help="where to write the .pxu files "
+                             "(default: benchmarking-provider/units)")
+    parser.add_argument('--launcher-dir', default='benchmarking-provider',
+                        help="where to write the launchers "
+                             "(default: benchmarking-provider)")
+    args = parser.parse_args()
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as exc:
+        raise SystemExit(exc)
+    for load in grid_points(grid):
+        prefix = 'synthetic-{}'.format(load_tag(load))
+        write_load(load, os.path.join(args.units_dir, prefix + '.pxu'),
+                   os.path.join(args.launcher_dir, 'launcher-' + prefix),
+                   prefix)
+        print("{}: {} jobs".format(prefix, job_count(load)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+On-disk catalog of the units that CheckboxTool works with.
+
+Loading all the providers through plainbox takes seconds, so the little
+metadata the tools need (jobs, templates and test plans) is extracted once per
+provider and stored in a cache directory.  A provider is only read again when
+one of its files changes.
+
+Besides the providers on PROVIDERPATH, plainbox has built-in providers (the
+manifest, exporters and categories) with units such as
+com.canonical.plainbox::manifest.  They are cataloged too, and read again
+whenever plainbox's own provider files change.  Sideloaded providers are not
+covered.
+"""
+import configparser
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import time
+from collections import namedtuple
+
+CATALOG_VERSION = 3
+
+BUILTIN_PROVIDERS = ['manifest', 'exporters', 'categories']
+BUILTIN_PREFIX = 'plainbox:'
+
+
+Origin = namedtuple('Origin', ['filename', 'line_start', 'line_end'])
+
+
+def default_cache_dir():
+    xdg_cache_home = os.getenv(
+        'XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg_cache_home, 'checkbox-tools')
+
+
+def get_provider_path():
+    """Return the directories plainbox looks in for .provider files."""
+    if os.getenv('PROVIDERPATH'):
+        return os.getenv('PROVIDERPATH').split(os.path.pathsep)
+    xdg_data_home = os.getenv(
+        'XDG_DATA_HOME', os.path.expanduser('~/.local/share/'))
+    return ['/usr/local/share/plainbox-providers-1',
+            '/usr/share/plainbox-providers-1',
+            os.path.join(xdg_data_home, 'plainbox-providers-1')]
+
+
+def find_provider_files():
+    provider_files = []
+    for path in get_provider_path():
+        provider_files += sorted(glob.glob(os.path.join(path, '*.provider')))
+    return provider_files
+
+
+def builtin_providers_dir():
+    """Where plainbox keeps its built-in providers, None without plainbox."""
+    # finding the package does not import it
+    spec = importlib.util.find_spec('plainbox')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return os.path.join(
+        list(spec.submodule_search_locations)[0], 'impl', 'providers')
+
+
+def find_builtin_providers():
+    """Return the built-in providers, named like plainbox:manifest."""
+    if builtin_providers_dir() is None:
+        return []
+    return [BUILTIN_PREFIX + name for name in BUILTIN_PROVIDERS]
+
+
+def provider_unit_dirs(provider_file):
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(provider_file)
+    section = parser['PlainBox Provider'] if parser.has_section(
+        'PlainBox Provider') else {}
+    location = section.get('location')
+    unit_dirs = []
+    for key, default in [('units_dir', 'units'), ('jobs_dir', 'jobs')]:
+        if section.get(key):
+            unit_dirs.append(section.get(key))
+        elif location:
+            unit_dirs.append(os.path.join(location, default))
+    return unit_dirs
+
+
+def provider_fingerprint(provider_file):
+    """Hash of paths, sizes and mtimes of everything the provider loads."""
+    if provider_file.startswith(BUILTIN_PREFIX):
+        # built-in providers change when plainbox's providers package does
+        paths = []
+        unit_dirs = [builtin_providers_dir()]
+    else:
+        paths = [provider_file]
+        unit_dirs = provider_unit_dirs(provider_file)
+    for unit_dir in unit_dirs:
+        for root, dirs, files in os.walk(unit_dir):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            paths += [os.path.join(root, name) for name in sorted(files)]
+    fingerprint = hashlib.sha1(str(CATALOG_VERSION).encode())
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.update('{}\0{}\0{}\n'.format(
+            path, stat.st_mtime_ns, stat.st_size).encode())
+    return fingerprint.hexdigest()
+
+
+class Record:
+    def __init__(self, namespace, **fields):
+        self.namespace = namespace
+        self.__dict__.update(fields)
+
+    def qualify_id(self, some_id):
+        if "::" not in some_id and self.namespace:
+            return "{}::{}".format(self.namespace, some_id)
+        else:
+            return some_id
+
+    def copy(self, **changes):
+        fields = dict(self.__dict__)
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return "<{} id:{!r}>".format(self.__class__.__name__, self.id)
+
+
+class UnitRecord(Record):
+    """A job or a template: id, plugin and depends."""
+
+
+class TestPlanRecord(Record):
+    FIELDS = ['id', 'unit', 'name', 'description', 'include',
+              'bootstrap_include', 'mandatory_include', 'exclude',
+              'nested_part', 'estimated_duration']
+
+    def __init__(self, namespace, origin, **fields):
+        super().__init__(namespace, origin=Origin(*origin), **fields)
+
+
+def plainbox_classes():
+    """Import, on first use, the plainbox classes the catalog is built with."""
+    from plainbox.impl.secure.providers.v1 import Provider1
+    from plainbox.impl.secure.providers.v1 import Provider1Definition
+    from plainbox.impl.unit.job import JobDefinition
+    from plainbox.impl.unit.template import TemplateUnit
+    from plainbox.impl.unit.testplan import TestPlanUnit
+    return (Provider1, Provider1Definition, JobDefinition, TemplateUnit,
+            TestPlanUnit)
+
+
+def build_provider_catalog(provider_file):
+    """Load one provider with plainbox and extract its unit metadata."""
+    (Provider1, Provider1Definition, JobDefinition, TemplateUnit,
+     TestPlanUnit) = plainbox_classes()
+    if provider_file.startswith(BUILTIN_PREFIX):
+        from plainbox.impl.providers import special
+        provider = getattr(
+            special, 'get_' + provider_file[len(BUILTIN_PREFIX):])()
+    else:
+        definition = Provider1Definition()
+        definition.read([provider_file])
+        provider = Provider1.from_definition(definition, secure=False)
+    catalog = {'provider': provider.name, 'jobs': [], 'templates': [],
+               'test_plans': []}
+    for unit in provider.unit_list:
+        u_type = type(unit)
+        if u_type == TemplateUnit:
+            catalog['templates'].append(UnitRecord(
+                provider.namespace, id=unit.id,
+                plugin=unit.get_record_value('plugin'),
+                depends=unit.get_record_value('depends')).to_dict())
+        elif issubclass(u_type, JobDefinition):
+            catalog['jobs'].append(UnitRecord(
+                provider.namespace, id=unit.id, plugin=unit.plugin,
+                depends=unit.depends).to_dict())
+        elif issubclass(u_type, TestPlanUnit):
+            fields = {field: unit.get_record_value(field)
+                      for field in TestPlanRecord.FIELDS}
+            fields.update(id=unit.id, unit='test plan', name=unit.name,
+                          description=unit.description)
+            # kept so that rewriting the plan can tell what it would lose
+            fields['extra_fields'] = sorted(
+                field.lstrip('_') for field in unit._raw_data
+                if field.lstrip('_') not in TestPlanRecord.FIELDS)
+            origin = [unit.origin.source.filename, unit.origin.line_start,
+                      unit.origin.line_end]
+            catalog['test_plans'].append(TestPlanRecord(
+                provider.namespace, origin, **fields).to_dict())
+    return catalog
+
+
+class UnitCatalog:
+    """
+    Jobs, templates and test plans of all the available providers.
+
+    Providers are discovered when the catalog is created and their units are
+    read by `load()`.  With `cache_dir` set, each provider's part of the
+    catalog is stored there and reused for as long as the provider's
+    fingerprint stays the same.  `import_time` is the time spent importing
+    plainbox, which only happens when a provider has to be rebuilt.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        # built-in providers are listed as plainbox:NAME
+        self.provider_files = find_provider_files() + find_builtin_providers()
+        self.jobs = dict()
+        self.templates = dict()
+        self.test_plans = dict()
+        self.provider_test_plans = dict()
+        self.rebuilt = []
+        self.import_time = 0.0
+
+    def load(self):
+        for provider_file in self.provider_files:
+            catalog = self._load_provider(provider_file)
+            for record in catalog['jobs']:
+                self.jobs[record['id']] = UnitRecord(**record)
+            for record in catalog['templates']:
+                self.templates[record['id']] = UnitRecord(**record)
+            for record in catalog['test_plans']:
+                self.test_plans[record['id']] = TestPlanRecord(**record)
+            self.provider_test_plans.setdefault(catalog['provider'], []).extend(
+                record['id'] for record in catalog['test_plans'])
+
+    def _cache_path(self, provider_file):
+        return os.path.join(self.cache_dir, '{}.json'.format(
+            hashlib.sha1(provider_file.encode()).hexdigest()))
+
+    def _load_provider(self, provider_file):
+        fingerprint = provider_fingerprint(provider_file)
+        if self.cache_dir:
+            try:
+                with open(self._cache_path(provider_file), 'rt') as f:
+                    catalog = json.load(f)
+                if catalog.get('fingerprint') == fingerprint:
+                    return catalog
+            except (OSError, ValueError):
+                pass
+        start = time.perf_counter()
+        plainbox_classes()
+        self.import_time += time.perf_counter() - start
+        catalog = build_provider_catalog(provider_file)
+        catalog['fingerprint'] = fingerprint
+        self.rebuilt.append(provider_file)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cache_path = self._cache_path(provider_file)
+            with open(cache_path + '.tmp', 'wt') as f:
+                json.dump(catalog, f)
+            os.replace(cache_path + '.tmp', cache_path)
+        return catalog
@@ -0,0 +1,153 @@
+# Copyright 2020 Canonical Ltd.
+# Written by:
+#   Maciej Kisielewski <maciej.kisielewski@canonical.com>
+#
+# Checkbox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# Checkbox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Checkbox.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of the virtualenvs benchmark.py runs checkbox in.
+
+Building a venv with mk-venv takes much longer than most benchmarks, yet the
+venv only depends on the files that declare checkbox's dependencies.  Venvs
+are therefore kept in a cache directory, keyed by a hash of those files, and
+whoever uses one develops their own checkbox tree into it.
+
+Every key can have several slots, each locked while in use, so concurrent
+benchmarks of different trees never share a venv.  When the cache grows over
+its size limit, the least recently used slots that are not locked get
+removed.
+"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import os
+import platform
+import re
+import shutil
+
+DEPENDENCY_FILES = ['mk-venv', 'setup.py', 'setup.cfg', 'requirements.txt',
+                    'requirements/*.txt']
+
+COMPLETE = '.complete'
+
+
+def default_cache_dir():
+    xdg_cache_home = os.getenv(
+        'XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg_cache_home, 'checkbox-benchmark', 'venvs')
+
+
+def parse_size(text):
+    """Turn sizes like 512M or 10G into bytes."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMGT]?)i?B?', text.strip(),
+                         re.IGNORECASE)
+    if not match:
+        raise ValueError("Bad size: {!r}".format(text))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+
+def dependency_key(tree):
+    """Hash of everything in `tree` that decides what goes into its venv."""
+    key = hashlib.sha1(platform.python_version().encode())
+    for pattern in DEPENDENCY_FILES:
+        for path in sorted(glob.glob(os.path.join(tree, pattern))):
+            with open(path, 'rb') as f:
+                key.update(os.path.relpath(path, tree).encode() + b'\0')
+                key.update(f.read())
+    return key.hexdigest()[:16]
+
+
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class VenvCache:
+    """
+    Venvs keyed by the dependencies of a checkbox tree.
+
+    `max_size` is in bytes; the venv in use is never evicted, even if it
+    alone is bigger than that.
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_size = max_size
+
+    @contextlib.contextmanager
+    def acquire(self, tree, build):
+        """
+        Lock a venv for `tree` for the duration of the context.
+
+        If there is no free venv with the right dependencies, `build(path)`
+        is called to create one at `path`.  Yield the path of the venv.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key = dependency_key(tree)
+        slot = 0
+        while True:
+            path = os.path.join(self.cache_dir, '{}-{}'.format(key, slot))
+            lock = self._try_lock(path)
+            if lock:
+                break
+            slot += 1
+        with lock:
+            if not os.path.exists(os.path.join(path, COMPLETE)):
+                shutil.rmtree(path, ignore_errors=True)
+                build(path)
+                open(os.path.join(path, COMPLETE), 'wt').close()
+            # the marker's mtime tells which venvs were used least recently
+            os.utime(os.path.join(path, COMPLETE))
+            self.evict(keep=path)
+            yield path
+
+    def _try_lock(self, path):
+        lock = open(path + '.lock', 'at')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def evict(self, keep=None):
+        """Remove least recently used venvs until the cache fits its size."""
+        if self.max_size is None:
+            return
+        venvs = []
+        for lock_path in glob.glob(os.path.join(self.cache_dir, '*.lock')):
+            path = lock_path[:-len('.lock')]
+            try:
+                last_used = os.stat(os.path.join(path, COMPLETE)).st_mtime
+            except OSError:
+                last_used = 0
+            venvs.append((last_used, path, tree_size(path)))
+        total = sum(size for _, _, size in venvs)
+        for _, path, size in sorted(venvs):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            lock = self._try_lock(path)
+            if not lock:
+                continue
+            # the lock file stays, so nobody can end up holding a lock on a
+            # file that is no longer there
+            with lock:
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size